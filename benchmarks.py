@@ -0,0 +1,217 @@
+'''
+calibre_plugins.comicvine - micro-benchmarks
+
+Run with the plugin installed using:
+
+    calibre-debug -e benchmarks.py [benchmark ...]
+'''
+import sys
+import timeit
+
+def _candidates(count=200):
+  'Build result records resembling a typical identify result set'
+  from calibre.ebooks.metadata.book.base import Metadata
+  import datetime
+  candidates = []
+  for i in range(count):
+    meta = Metadata('Batman #%d' % (i % 50), ['Grant Morrison'])
+    meta.series = ['Batman', 'Batman and Robin', 'Batman: The Dark Knight',
+                   'Detective Comics'][i % 4]
+    meta.series_index = str(i % 50)
+    meta.comments = ('Collecting issues #1-6' if i % 7 == 0 else
+                     'The Dark Knight faces a new threat in Gotham City.')
+    meta.pubdate = datetime.datetime(2006 + i % 8, 1, 1)
+    candidates.append(meta)
+  return candidates
+
+def bench_keygen(repeat=5, number=20):
+  'Ranking keys per second with and without memoised scoring inputs'
+  from calibre_plugins.comicvine import utils
+  from calibre_plugins.comicvine.source import Comicvine
+  plugin = Comicvine(None)
+  candidates = _candidates()
+  title = 'Batman and Robin #12 (2011)'
+
+  def rank_cold():
+    'Key every candidate, forgetting memoised inputs first'
+    for meta in candidates:
+      utils.clear_title_caches()
+      plugin.identify_results_keygen(title, ['Grant Morrison'], {})(meta)
+
+  def rank_warm():
+    'Key every candidate as calibre does when sorting results'
+    keygen = plugin.identify_results_keygen(title, ['Grant Morrison'], {})
+    for meta in candidates:
+      keygen(meta)
+
+  for name, function in (('uncached', rank_cold), ('memoised', rank_warm)):
+    best = min(timeit.repeat(function, repeat=repeat, number=number))
+    print '%-10s %10.0f keys/s' % (name, len(candidates) * number / best)
+
+def bench_edit_distance(repeat=5, number=20):
+  'Title similarity per second, built-in fallback against python-Levenshtein'
+  from calibre_plugins.comicvine import utils
+  series = [u'Batman', u'Batman and Robin', u'Batman: The Dark Knight',
+            u'Detective Comics', u'The Amazing Spider-Man',
+            u'Uncanny X-Men', u'Green Lantern Corps', u'Sandman']
+  pairs = [(volume, title) for volume in series for title in series]
+  functions = [
+    ('indel_ratio', lambda a, b: utils.indel_ratio(a, b)),
+    ('edit_distance', lambda a, b: utils.edit_distance(a, b)),
+    ('bounded', lambda a, b: utils.edit_distance(a, b, max_distance=3)),
+  ]
+  if utils.Levenshtein is not None:
+    functions += [
+      ('C ratio', utils.Levenshtein.ratio),
+      ('C distance', utils.Levenshtein.distance),
+    ]
+  for name, function in functions:
+    def run(function=function):
+      'Compare every pair of series names'
+      for volume, title in pairs:
+        function(volume, title)
+    best = min(timeit.repeat(run, repeat=repeat, number=number))
+    print '%-14s %10.0f pairs/s' % (name, len(pairs) * number / best)
+
+def _footprint(resource):
+  'Bytes held by a resource object itself, excluding its field values'
+  size = sys.getsizeof(resource)
+  try:
+    attributes = object.__getattribute__(resource, '__dict__')
+  except AttributeError:
+    return size + sys.getsizeof(object.__getattribute__(resource, '_fields'))
+  return size + sys.getsizeof(attributes) + sum(
+    sys.getsizeof(value) for value in attributes.values())
+
+def bench_resources(count=100000, repeat=5):
+  'Memory and attribute access cost of loaded Issue objects'
+  from calibre_plugins.comicvine import pycomicvine
+  try:
+    issues = [
+      pycomicvine.Issue(
+        i, do_not_download=True, name=u'Issue %d' % i, issue_number=str(i),
+        volume={'id': 796, 'name': u'Batman'}, store_date='2012-01-01')
+      for i in range(1, count + 1)]
+    print '%-14s %10.1f bytes/object' % (
+      'footprint', sum(_footprint(issue) for issue in issues) / float(count))
+
+    def read():
+      'Read three fields of every issue'
+      for issue in issues:
+        issue.name
+        issue.issue_number
+        issue.volume
+    best = min(timeit.repeat(read, repeat=repeat, number=1))
+    print '%-14s %10.0f ns/access' % ('attributes', best / (3 * count) * 1e9)
+  finally:
+    pycomicvine.resource_cache().clear()
+
+def _issues_page(count=100):
+  'JSON body of an issues/ list page as returned by the API'
+  import json
+  results = []
+  for i in range(count):
+    results.append({
+      'id': 300000 + i,
+      'name': u'Part %d: The Black Glove' % i,
+      'issue_number': str(i % 50 + 1),
+      'volume': {'id': 796 + i % 4, 'name': u'Batman',
+                 'api_detail_url': 'https://comicvine.gamespot.com/api/'
+                                   'volume/4050-%d/' % (796 + i % 4)},
+      'description': u'<p>The Dark Knight faces a new threat.</p>' * 10,
+      'store_date': '20%02d-%02d-%02d' % (i % 15, i % 12 + 1, i % 28 + 1),
+      'cover_date': '20%02d-%02d-01' % (i % 15, i % 12 + 1),
+      'date_last_updated': '2014-%02d-%02d 12:%02d:%02d' % (
+        i % 12 + 1, i % 28 + 1, i % 60, i % 60),
+      'person_credits': [
+        {'id': 40382, 'name': u'Grant Morrison', 'role': u'writer'},
+        {'id': 40439, 'name': u'Tony S. Daniel', 'role': u'penciler'}],
+    })
+  return json.dumps({
+    'error': 'OK', 'limit': 100, 'offset': 0,
+    'number_of_page_results': count, 'number_of_total_results': count,
+    'status_code': 1, 'results': results, 'version': '1.0'})
+
+def bench_decode(repeat=5, number=20):
+  'Decoding a 100 result issues/ page and reading its fields'
+  import json
+  import dateutil.parser
+  from calibre_plugins.comicvine import pycomicvine
+  body = _issues_page()
+  fields = ('name', 'issue_number', 'volume', 'store_date', 'cover_date',
+            'date_last_updated')
+
+  def load():
+    'Decode the page and read the fields the plugin uses'
+    pycomicvine.resource_cache().clear()
+    response = pycomicvine.json.loads(body)
+    for issue in pycomicvine.Issues(response['results']):
+      for field in fields:
+        getattr(issue, field)
+
+  dates = [result[field] for result in json.loads(body)['results']
+           for field in ('store_date', 'cover_date', 'date_last_updated')]
+
+  def parse_dateutil():
+    'Parse every date of the page with dateutil'
+    for date in dates:
+      dateutil.parser.parse(date)
+
+  def parse_fast():
+    'Parse every date of the page without the conversion memo'
+    for date in dates:
+      pycomicvine._parse_datetime(date)
+
+  for name, function in (
+      ('json', lambda: json.loads(body)),
+      ('%s' % pycomicvine.json.__name__, lambda: pycomicvine.json.loads(body)),
+      ('dateutil', parse_dateutil),
+      ('fixed format', parse_fast),
+      ('page', load)):
+    best = min(timeit.repeat(function, repeat=repeat, number=number))
+    print '%-14s %10.2f ms/page' % (name, best / number * 1000)
+
+# Modules the plugin should not need to import up front
+DEFERRED_MODULES = ('PyQt4.Qt', 'dateutil.parser', 'urllib2',
+                    'calibre.ebooks.metadata.opf2', 'sqlite3')
+
+def bench_import(repeat=5):
+  'Time to import the plugin and the slow modules it loads'
+  plugin = 'calibre_plugins.comicvine'
+  preloaded = set(name for name in DEFERRED_MODULES if name in sys.modules)
+
+  def purge():
+    'Forget the plugin modules so the next import starts from scratch'
+    for name in list(sys.modules):
+      if name == plugin or name.startswith(plugin + '.'):
+        del sys.modules[name]
+
+  def load():
+    'Import the plugin and build the source as calibre does'
+    purge()
+    module = __import__(plugin + '.source', fromlist=['Comicvine'])
+    module.Comicvine(None).initialize()
+
+  times = []
+  for _ in range(repeat):
+    start = timeit.default_timer()
+    load()
+    times.append(timeit.default_timer() - start)
+  print '%-14s %10.1f ms' % ('first import', times[0] * 1000)
+  print '%-14s %10.1f ms' % ('reimport', min(times[1:] or times) * 1000)
+  loaded = [name for name in DEFERRED_MODULES
+            if name in sys.modules and name not in preloaded]
+  print '%-14s %s' % ('loaded', ', '.join(loaded) or 'none')
+
+BENCHMARKS = {
+  'decode': bench_decode,
+  'edit_distance': bench_edit_distance,
+  'import': bench_import,
+  'keygen': bench_keygen,
+  'resources': bench_resources,
+}
+
+if __name__ == '__main__':
+  for benchmark in sys.argv[1:] or sorted(BENCHMARKS):
+    print '== %s: %s' % (benchmark, BENCHMARKS[benchmark].__doc__)
+    BENCHMARKS[benchmark]()
@@ -1,12 +1,15 @@
 '''
 Configuration for the Comicvine metadata source
 '''
+import os
 import time
 
-from PyQt4.Qt import QWidget, QGridLayout, QLabel, QLineEdit
-from calibre.utils.config import JSONConfig
+from calibre.utils.config import JSONConfig, config_dir
 
 from calibre_plugins.comicvine  import pycomicvine
+from calibre_plugins.comicvine.pycomicvine.cache import (
+  DEFAULT_RESPONSE_TTLS, ResponseCache)
+from calibre_plugins.comicvine.pycomicvine.sync import SYNCED_TTLS
 
 PREFS = JSONConfig('plugins/comicvine')
 PREFS.defaults['api_key'] = ''
@@ -15,33 +18,52 @@ PREFS.defaults['requests_rate'] = 0.1
 PREFS.defaults['requests_burst'] = 10
 PREFS.defaults['requests_tokens'] = 0
 PREFS.defaults['requests_update'] = time.time()
+PREFS.defaults['resource_cache_size'] = 10000
+PREFS.defaults['response_cache_size'] = 50
+PREFS.defaults['cover_cache_size'] = 200
+# Stop volume searches early once the best volume_top_k name matches are
+# known, 0 loads every page of results
+PREFS.defaults['volume_top_k'] = 0
+# Weight title similarity once per title token, as older versions did
+PREFS.defaults['legacy_ranking'] = True
+# Answer volume searches from a local index of volume names, refreshing
+# up to volume_index_pages pages of updated volumes once a day
+PREFS.defaults['volume_index'] = False
+PREFS.defaults['volume_index_pages'] = 10
+# Invalidate cached issues and volumes changed on comicvine, checking up
+# to cache_sync_pages pages of changes at most once an hour, so they can
+# be cached for longer
+PREFS.defaults['cache_sync'] = False
+PREFS.defaults['cache_sync_pages'] = 10
 pycomicvine.api_key = PREFS['api_key']
 
-class ConfigWidget(QWidget):
-  'Configuration widget'
-  def __init__(self):
-    QWidget.__init__(self)
-    self.layout = QGridLayout()
-    self.layout.setSpacing(10)
-    self.setLayout(self.layout)
+RESPONSE_CACHE_PATH = os.path.join(
+  config_dir, 'plugins', 'comicvine_responses.sqlite')
+TOKEN_STATE_PATH = os.path.join(
+  config_dir, 'plugins', 'comicvine_tokens.bin')
+VOLUME_INDEX_PATH = os.path.join(
+  config_dir, 'plugins', 'comicvine_volumes.sqlite')
+COVER_CACHE_PATH = os.path.join(
+  config_dir, 'plugins', 'comicvine_covers')
 
-    self.key_label = QLabel('&api key:')
-    self.key_msg = QLineEdit(self)
-    self.key_msg.setText(PREFS['api_key'])
-    self.layout.addWidget(self.key_label, 1, 0)
-    self.layout.addWidget(self.key_msg, 1, 1)
-    self.key_label.setBuddy(self.key_msg)
-
-    self.threads_label = QLabel('&worker_threads:')
-    self.threads_msg = QLineEdit(self)
-    self.threads_msg.setText(unicode(PREFS['worker_threads']))
-    self.layout.addWidget(self.threads_label, 2, 0)
-    self.layout.addWidget(self.threads_msg, 2, 1)
-    self.threads_label.setBuddy(self.threads_msg)
-
-  def save_settings(self):
-    'Apply new settings value'
-    PREFS['api_key'] = unicode(self.key_msg.text())
-    PREFS['worker_threads'] = int(self.threads_msg.text())
-    pycomicvine.api_key = PREFS['api_key']
+def install_response_cache():
+  'Enable the on-disk API response cache (size in MB, 0 disables it)'
+  max_bytes = PREFS['response_cache_size'] * 1024 * 1024
+  cache = pycomicvine.response_cache()
+  ttls = SYNCED_TTLS if PREFS['cache_sync'] else None
+  if not max_bytes:
+    if cache is not None:
+      cache.flush()
+    pycomicvine.set_response_cache(None)
+  elif cache is None:
+    pycomicvine.set_response_cache(
+      ResponseCache(RESPONSE_CACHE_PATH, max_bytes=max_bytes, ttls=ttls))
+  else:
+    cache.max_bytes = max_bytes
+    cache.ttls = dict(DEFAULT_RESPONSE_TTLS, **(ttls or {}))
 
+def configure_transport():
+  'Size the connection pools to the worker threads, if the transport has any'
+  configure = getattr(pycomicvine.transport(), 'configure', None)
+  if configure is not None:
+    configure(PREFS['worker_threads'])
@@ -0,0 +1,59 @@
+'''
+Configuration widget for the Comicvine metadata source
+'''
+from PyQt4.Qt import QWidget, QGridLayout, QLabel, QLineEdit
+
+from calibre_plugins.comicvine import pycomicvine
+from calibre_plugins.comicvine.config import (PREFS, configure_transport,
+                                              install_response_cache)
+
+class ConfigWidget(QWidget):
+  'Configuration widget'
+  def __init__(self):
+    QWidget.__init__(self)
+    self.layout = QGridLayout()
+    self.layout.setSpacing(10)
+    self.setLayout(self.layout)
+
+    self.key_label = QLabel('&api key:')
+    self.key_msg = QLineEdit(self)
+    self.key_msg.setText(PREFS['api_key'])
+    self.layout.addWidget(self.key_label, 1, 0)
+    self.layout.addWidget(self.key_msg, 1, 1)
+    self.key_label.setBuddy(self.key_msg)
+
+    self.threads_label = QLabel('&worker_threads:')
+    self.threads_msg = QLineEdit(self)
+    self.threads_msg.setText(unicode(PREFS['worker_threads']))
+    self.layout.addWidget(self.threads_label, 2, 0)
+    self.layout.addWidget(self.threads_msg, 2, 1)
+    self.threads_label.setBuddy(self.threads_msg)
+
+    self.cache_label = QLabel('&response_cache_size (MB):')
+    self.cache_msg = QLineEdit(self)
+    self.cache_msg.setText(unicode(PREFS['response_cache_size']))
+    self.layout.addWidget(self.cache_label, 3, 0)
+    self.layout.addWidget(self.cache_msg, 3, 1)
+    self.cache_label.setBuddy(self.cache_msg)
+    self.cache_usage = QLabel(self.cache_usage_text())
+    self.layout.addWidget(self.cache_usage, 4, 1)
+
+  def cache_usage_text(self):
+    'Describe the current size of the response cache'
+    install_response_cache()
+    cache = pycomicvine.response_cache()
+    if cache is None:
+      return 'Response cache disabled'
+    stats = cache.stats()
+    return '%.1f MB used by %d cached responses' % (
+      stats['bytes'] / (1024.0 * 1024), stats['entries'])
+
+  def save_settings(self):
+    'Apply new settings value'
+    PREFS['api_key'] = unicode(self.key_msg.text())
+    PREFS['worker_threads'] = int(self.threads_msg.text())
+    PREFS['response_cache_size'] = int(self.cache_msg.text())
+    pycomicvine.api_key = PREFS['api_key']
+    configure_transport()
+    install_response_cache()
+
@@ -0,0 +1,147 @@
+'''
+calibre_plugins.comicvine - on-disk cover image cache
+'''
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+class CoverCache(object):
+  '''Content addressed cache of cover images.
+
+  Entries are keyed by issue id and image size and point to an image
+  file named after the SHA-1 of its contents, so sizes or issues sharing
+  an image store it once.  An entry is fresh for ttl seconds; after that
+  the ETag and Last-Modified validators it was stored with are sent as a
+  conditional request, and a 304 response makes it fresh again.  When
+  the images exceed max_bytes the least recently used entries are
+  removed, along with the images no entry refers to any more.
+  '''
+  def __init__(self, path, max_bytes=200 * 1024 * 1024,
+               ttl=30 * 24 * 60 * 60, clock=time.time):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.clock = clock
+    self.lock = threading.RLock()
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self.db = sqlite3.connect(os.path.join(path, 'covers.sqlite'),
+                              timeout=30, check_same_thread=False)
+    with self.lock:
+      self.db.executescript('''
+        CREATE TABLE IF NOT EXISTS covers (
+          issue INTEGER, size TEXT, url TEXT, digest TEXT, etag TEXT,
+          last_modified TEXT, stored REAL, accessed REAL,
+          PRIMARY KEY (issue, size));
+        CREATE INDEX IF NOT EXISTS covers_accessed ON covers (accessed);
+        CREATE INDEX IF NOT EXISTS covers_digest ON covers (digest);
+        CREATE TABLE IF NOT EXISTS images (
+          digest TEXT PRIMARY KEY, bytes INTEGER);
+      ''')
+      self.db.commit()
+
+  def _image_path(self, digest):
+    return os.path.join(self.path, digest[:2], digest)
+
+  def get(self, issue, size, url):
+    '''Returns (data, fresh, headers) for a cover
+
+    data is None if the cover is not cached from url, headers are the
+    conditional request headers to revalidate a stale cover with.
+    '''
+    with self.lock:
+      row = self.db.execute(
+        'SELECT url, digest, etag, last_modified, stored FROM covers '
+        'WHERE issue = ? AND size = ?', (issue, size)).fetchone()
+      if row is None or row[0] != url:
+        return None, False, []
+      (_, digest, etag, last_modified, stored) = row
+      try:
+        with open(self._image_path(digest), 'rb') as image:
+          data = image.read()
+      except IOError:
+        self._delete(issue, size)
+        self.db.commit()
+        return None, False, []
+      self.db.execute(
+        'UPDATE covers SET accessed = ? WHERE issue = ? AND size = ?',
+        (self.clock(), issue, size))
+      self.db.commit()
+    headers = []
+    if etag:
+      headers.append(('If-None-Match', str(etag)))
+    if last_modified:
+      headers.append(('If-Modified-Since', str(last_modified)))
+    return data, self.clock() - stored <= self.ttl, headers
+
+  def put(self, issue, size, url, data, etag=None, last_modified=None):
+    'Store a downloaded cover with its validators'
+    digest = hashlib.sha1(data).hexdigest()
+    image_path = self._image_path(digest)
+    now = self.clock()
+    with self.lock:
+      self._delete(issue, size)
+      if not os.path.exists(image_path):
+        directory = os.path.dirname(image_path)
+        if not os.path.isdir(directory):
+          os.makedirs(directory)
+        tmp_path = image_path + '.tmp'
+        with open(tmp_path, 'wb') as image:
+          image.write(data)
+        os.rename(tmp_path, image_path)
+      self.db.execute(
+        'INSERT OR REPLACE INTO images (digest, bytes) VALUES (?, ?)',
+        (digest, len(data)))
+      self.db.execute(
+        'INSERT INTO covers VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (issue, size, url, digest, etag, last_modified, now, now))
+      self._evict()
+      self.db.commit()
+
+  def revalidated(self, issue, size):
+    'Mark a cover fresh after the server reported it unchanged'
+    with self.lock:
+      self.db.execute(
+        'UPDATE covers SET stored = ? WHERE issue = ? AND size = ?',
+        (self.clock(), issue, size))
+      self.db.commit()
+
+  def _delete(self, issue, size):
+    'Remove an entry, and its image if no other entry uses it'
+    row = self.db.execute(
+      'SELECT digest FROM covers WHERE issue = ? AND size = ?',
+      (issue, size)).fetchone()
+    if row is None:
+      return
+    self.db.execute(
+      'DELETE FROM covers WHERE issue = ? AND size = ?', (issue, size))
+    (digest,) = row
+    if self.db.execute('SELECT 1 FROM covers WHERE digest = ?',
+                       (digest,)).fetchone() is None:
+      self.db.execute('DELETE FROM images WHERE digest = ?', (digest,))
+      try:
+        os.remove(self._image_path(digest))
+      except OSError:
+        pass
+
+  def _evict(self):
+    total = self.db.execute('SELECT TOTAL(bytes) FROM images').fetchone()[0]
+    if total <= self.max_bytes:
+      return
+    for (issue, size) in self.db.execute(
+        'SELECT issue, size FROM covers ORDER BY accessed').fetchall():
+      self._delete(issue, size)
+      total = self.db.execute(
+        'SELECT TOTAL(bytes) FROM images').fetchone()[0]
+      if total <= self.max_bytes:
+        break
+
+  def stats(self):
+    'Number of cached covers and bytes used by their images'
+    with self.lock:
+      (covers,) = self.db.execute('SELECT COUNT(*) FROM covers').fetchone()
+      (total,) = self.db.execute(
+        'SELECT TOTAL(bytes) FROM images').fetchone()
+    return {'covers': covers, 'bytes': int(total)}
@@ -20,31 +20,214 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE 
 # SOFTWARE.
 
-import urllib2
 from urllib import urlencode
 try:
-    import simplejson as json
+    import ujson as json
 except ImportError:
-    import json
-import sys, re
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
+import sys, re, time
 import datetime, logging
-import dateutil.parser
+import copy, threading
 from . import error
+from .cache import ResourceCache, RESOURCE_ENDPOINTS
 import collections
 
 _API_URL = "https://www.comicvine.com/api/"
 
-_cached_resources = {}
+_cached_resources = ResourceCache()
+_response_cache = None
+_transport = None
+_transport_lock = threading.Lock()
 _api_hooks = {}
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_request_stats = {'requests': 0, 'coalesced': 0}
+# HTTP statuses the API is throttled with instead of status_code 107
+_RATE_LIMIT_HTTP_STATUSES = (420, 429)
 
 api_key = ""
 
-def str_to_datetime(value):
+# Converted date strings, shared since many resources carry the same dates
+_converted_dates = {}
+_MAX_CONVERTED_DATES = 4096
+
+def _parse_datetime(value):
+    # The API returns "YYYY-MM-DD" and "YYYY-MM-DD HH:MM:SS", which are
+    # split directly; anything else is left to dateutil
+    try:
+        if len(value) == 10 and value[4] == '-' and value[7] == '-':
+            return datetime.datetime(
+                    int(value[0:4]), int(value[5:7]), int(value[8:10])
+                )
+        if len(value) == 19 and value[4] == '-' and value[7] == '-' and \
+                value[10] == ' ' and value[13] == ':' and value[16] == ':':
+            return datetime.datetime(
+                    int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]), int(value[17:19])
+                )
+    except ValueError:
+        pass
+    # dateutil is slow to import, so it is loaded on first use
+    import dateutil.parser
     try:
         return dateutil.parser.parse(value)
     except ValueError:
         return value
 
+def str_to_datetime(value):
+    converted = _converted_dates.get(value)
+    if converted == None:
+        converted = _parse_datetime(value)
+        if len(_converted_dates) >= _MAX_CONVERTED_DATES:
+            _converted_dates.clear()
+        _converted_dates[value] = converted
+    return converted
+
+def resource_cache():
+    return _cached_resources
+
+def set_resource_cache(cache):
+    global _cached_resources
+    _cached_resources = cache
+
+def response_cache():
+    return _response_cache
+
+def set_response_cache(cache):
+    global _response_cache
+    _response_cache = cache
+
+def transport():
+    global _transport
+    if _transport == None:
+        with _transport_lock:
+            if _transport == None:
+                from .transport import HTTPTransport
+                _transport = HTTPTransport()
+    return _transport
+
+def set_transport(transport):
+    global _transport
+    _transport = transport
+
+def _download(url, timeout = None):
+    hook_run('pre_request_hook')
+    logging.getLogger(__name__).debug("Calling "+url)
+    start = time.time()
+    try:
+        body = transport().fetch(url, timeout)
+    except Exception, e:
+        # Throttling reported through the HTTP status is handled like a
+        # rate limit response (status_code 107)
+        if getattr(e, 'code', None) not in _RATE_LIMIT_HTTP_STATUSES:
+            raise
+        hook_run('post_request_hook', 107, time.time() - start)
+        raise error.RateLimitExceededError(
+                "HTTP {0:d} rate limit".format(e.code)
+            )
+    response_raw = json.loads(body)
+    hook_run(
+            'post_request_hook',
+            response_raw.get('status_code'),
+            time.time() - start
+        )
+    return body, response_raw
+
+def _response_resources(endpoint, response_raw):
+    """Tracked resources in a response, mapped to date_last_updated."""
+    results = response_raw.get('results')
+    if isinstance(results, dict):
+        results = [results]
+    elif not isinstance(results, list):
+        return {}
+    resources = {}
+    for result in results:
+        if not isinstance(result, dict) or 'id' not in result:
+            continue
+        name = RESOURCE_ENDPOINTS.get(
+                result.get('resource_type', endpoint)
+            )
+        if name != None:
+            resources["{0}-{1}".format(name, result['id'])] = \
+                    result.get('date_last_updated')
+    return resources
+
+def _cached_fetch(url, timeout = None):
+    cache = _response_cache
+    if cache == None:
+        return _download(url, timeout)[1]
+    key = cache.key(url)
+
+    def _refresh():
+        body, response_raw = _download(url, timeout)
+        if response_raw.get('status_code') == 1:
+            cache.put(key, body, _response_resources(
+                    cache.endpoint(key),
+                    response_raw
+                ))
+        return response_raw
+
+    body, fresh = cache.get(key)
+    if body == None:
+        return _refresh()
+    if not fresh:
+        cache.revalidate(key, _refresh)
+    return json.loads(body)
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.response_raw = None
+        self.exc_info = None
+        self.waiters = 0
+
+def request_stats():
+    with _in_flight_lock:
+        return dict(_request_stats)
+
+def _fetch(url, timeout = None, cache = True):
+    """Identical concurrent requests share a single network call.
+
+    Unless cache is set the response cache is bypassed, for requests
+    that will not be repeated.
+    """
+    with _in_flight_lock:
+        _request_stats['requests'] += 1
+        call = _in_flight.get(url)
+        leader = call == None
+        if leader:
+            call = _Call()
+            _in_flight[url] = call
+        else:
+            call.waiters += 1
+            _request_stats['coalesced'] += 1
+    if not leader:
+        call.done.wait()
+        if call.exc_info != None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        # Resources modify the results they are built from, so every
+        # caller gets its own copy
+        return copy.deepcopy(call.response_raw)
+    try:
+        if cache:
+            call.response_raw = _cached_fetch(url, timeout)
+        else:
+            call.response_raw = _download(url, timeout)[1]
+    except:
+        call.exc_info = sys.exc_info()
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[url]
+            waiters = call.waiters
+        call.done.set()
+    if waiters > 0:
+        return copy.deepcopy(call.response_raw)
+    return call.response_raw
+
 def hook_register(hook_name, callback):
     if callable(callback):
         _api_hooks[hook_name] = callback
@@ -120,6 +303,8 @@ class AttributeDefinition(object):
         return value
 
 class _Resource(object):
+    __slots__ = ()
+
     class _Response:
         def __init__(
                 self,
@@ -183,18 +368,14 @@ class _Resource(object):
             if timeout != None:
                 timeout = int(params['timeout'])
             del params['timeout']
+        cache = True
+        if 'cache' in params:
+            cache = params['cache']
+            del params['cache']
         params['format'] = 'json'
         params = urlencode(params)
         url = baseurl+"?"+params
-        hook_run('pre_request_hook')
-        logging.getLogger(__name__).debug("Calling "+url)
-        if timeout == None:
-            response_raw = json.loads(urllib2.urlopen(url).read())
-        else:
-            response_raw = json.loads(urllib2.urlopen(
-                    url, 
-                    timeout=timeout
-                ).read())
+        response_raw = _fetch(url, timeout, cache)
         response = type._Response(**response_raw)
         if response.status_code != 1:
             raise error.EXCEPTION_MAPPING.get(
@@ -208,7 +389,38 @@ class _Resource(object):
                 ].split('\n')
         return response
 
+class _SingularResourceType(type):
+    """Makes singular resources compact and fast to read.
+
+    Every class gets empty __slots__, so instances only hold the
+    _fields slot, and tables of the names of its AttributeDefinitions
+    (_definitions), of the ones needing a conversion (_converters) and of
+    the names that are not fields (_plain).  _aliases memoises the field
+    names returned by _fix_api_error.
+    """
+
+    def __new__(meta, name, bases, namespace):
+        namespace.setdefault('__slots__', ())
+        definitions = dict(
+                (key, value) for key, value in namespace.items()
+                if isinstance(value, AttributeDefinition)
+            )
+        namespace['_definitions'] = frozenset(definitions)
+        namespace['_aliases'] = {}
+        namespace['_converters'] = dict(
+                (key, value) for key, value in definitions.items()
+                if value._target_name != 'keep'
+            )
+        cls = super(_SingularResourceType, meta).__new__(
+                meta, name, bases, namespace
+            )
+        cls._plain = frozenset(dir(cls)) - cls._definitions
+        return cls
+
 class _SingularResource(_Resource):
+    __metaclass__ = _SingularResourceType
+    __slots__ = ('_fields',)
+
     def __new__(
             type,
             id,
@@ -222,17 +434,21 @@ class _SingularResource(_Resource):
                 type
             )
         try:
-            type_id = Types()[resource_type]['id']
+            type_dict = Types()[resource_type]
         except KeyError:
             return error.InvalidResourceError(
                     resource_type
                 )
         type._ensure_resource_url()
-        key = "{0:d}-{1:d}".format(type_id, id)
+        key = "{0:d}-{1:d}".format(type_dict['id'], id)
         obj = _cached_resources.get(key)
         if obj == None:
             obj = object.__new__(type)
-            _cached_resources[key] = obj
+            _cached_resources.put(
+                    key,
+                    obj,
+                    type_dict['detail_resource_name']
+                )
         return obj
 
     def __init__(
@@ -243,18 +459,13 @@ class _SingularResource(_Resource):
             do_not_download = False,
             **kwargs
         ):
-        if '_ready' not in self.__dict__:
-            self._ready = True
-            try:
-                type_id = Types()[type(self)]['id']
-            except KeyError:
-                raise error.InvalidResourceError(
-                        "Resource type '{0!s}' does not exist.".format(
-                                type(self)
-                            )
-                    )
-            self._detail_url = type(self)._resource_url + \
-                    "{0:d}-{1:d}/".format(type_id, id)
+        try:
+            ready = True
+            object.__getattribute__(self, '_fields')
+        except AttributeError:
+            ready = False
+        if not ready:
+            type(self)._ensure_detail_prefix()
             self._fields = {'id': id}
             if not do_not_download:
                 if all:
@@ -266,6 +477,9 @@ class _SingularResource(_Resource):
             if 'field_list' in kwargs:
                 del kwargs['field_list']
             self._fields.update(kwargs)
+        elif do_not_download:
+            # Payloads from list resources refresh an already known object
+            self._fields.update(kwargs)
         elif 'field_list' in kwargs:
             if not all or not do_not_download:
                 self._fields.update(self._request_object(
@@ -277,6 +491,28 @@ class _SingularResource(_Resource):
                         timeout=kwargs['timeout']
                     ).results)
 
+    @classmethod
+    def _ensure_detail_prefix(type):
+        if not '_detail_prefix' in type.__dict__:
+            try:
+                type_id = Types()[type]['id']
+            except KeyError:
+                raise error.InvalidResourceError(
+                        "Resource type '{0!s}' does not exist.".format(
+                                type
+                            )
+                    )
+            type._ensure_resource_url()
+            # Shared by every instance, only the id is added per request
+            type._detail_prefix = intern(
+                    type._resource_url + "{0:d}-".format(type_id)
+                )
+
+    @property
+    def _detail_url(self):
+        return type(self)._detail_prefix + \
+                str(object.__getattribute__(self, '_fields')['id']) + "/"
+
     def _request_object(self, field_list = None, timeout = None):
         if field_list == None:
             return type(self)._request(
@@ -290,42 +526,48 @@ class _SingularResource(_Resource):
                     timeout=timeout
                 )
 
+    def missing_fields(self, field_list):
+        fields = object.__getattribute__(self, '_fields')
+        fix = object.__getattribute__(self, '_fix_api_error')
+        return [name for name in field_list if fix(name) not in fields]
+
+    def ensure_fields(self, field_list, timeout = None):
+        missing = self.missing_fields(field_list)
+        if len(missing) > 0:
+            self._fields.update(self._request_object(
+                    missing,
+                    timeout=timeout
+                ).results)
+        return missing
+
+    def copy_fields(self, other):
+        """Adds the fields loaded into other that are missing here."""
+        fields = object.__getattribute__(self, '_fields')
+        for name, value in object.__getattribute__(
+                other, '_fields').items():
+            if name not in fields:
+                fields[name] = value
+
     def __getattribute__(self, name):
-        def _object_attribute(name):
+        cls = type(self)
+        if name[0] == '_' or name in cls._plain:
             return object.__getattribute__(self, name)
-
-        def _parse_attribute(name):
-            fields = _object_attribute('_fields')
-            value = _object_attribute('_fields')[name]
-            if name in filter(
-                    lambda x: not x.startswith('_'),
-                    type(self).__dict__
-                ):
-                definition = type(self).__dict__[name]
-                fields[name] = definition.convert(value)
-            return fields[name]
-
-        name = _object_attribute('_fix_api_error')(name)
+        alias = cls._aliases.get(name)
+        if alias == None:
+            alias = cls._aliases[name] = cls._fix_api_error(self, name)
+        name = alias
+        fields = object.__getattribute__(self, '_fields')
         try:
-            if name not in [
-                    '__class__', 
-                    '__dict__', 
-                    '__member__', 
-                    '__methods__', 
-                    '_request_object'
-                ] and name not in self.__dict__:
-                if name in _object_attribute('_fields'):
-                    return _parse_attribute(name)
-                else:
-                    self._fields.update(
-                            _object_attribute('_request_object')(
-                                    [name]
-                                ).results
-                        )
-                    return _parse_attribute(name)
+            if name not in fields:
+                fields.update(cls._request_object(self, [name]).results)
+            value = fields[name]
         except KeyError:
-            pass
-        return _object_attribute(name)
+            return object.__getattribute__(self, name)
+        converter = cls._converters.get(name)
+        if converter != None and \
+                not isinstance(value, (_Resource, datetime.datetime)):
+            value = fields[name] = converter.convert(value)
+        return value
 
     def _fix_api_error(self, name):
         return name
@@ -365,6 +607,8 @@ class _ListResource(_Resource):
         return type(self)._request(type(self)._resource_url, **params)
 
     def __init__(self, init_list = None, **kwargs):
+        self._lock = threading.RLock()
+        self._prefetching = {}
         if init_list != None:
             if len(kwargs) > 0:
                 raise TypeError(
@@ -374,11 +618,16 @@ class _ListResource(_Resource):
             self._results = init_list
             self._total = len(init_list)
             self._limit = len(init_list)
+            # Bitmap of loaded pages, a given list is a single page
+            self._loaded_pages = 1
         else:
             response = self._request_object(**kwargs)
             self._results = response.offset*[None] + response.results
             self._total = response.number_of_total_results
             self._limit = response.limit
+            self._loaded_pages = 0
+            if self._limit > 0 and response.offset % self._limit == 0:
+                self._loaded_pages = 1 << (response.offset / self._limit)
             if 'limit' in kwargs:
                 del kwargs['limit']
             if 'offset' in kwargs:
@@ -388,6 +637,61 @@ class _ListResource(_Resource):
     def __len__(self):
         return self._total
 
+    def _page_loaded(self, page):
+        return (self._loaded_pages >> page) & 1 == 1
+
+    def _load_page(self, page):
+        offset = page * self._limit
+        response = self._request_object(
+                limit=self._limit,
+                offset=offset,
+                **self._args
+            )
+        if response.number_of_page_results != len(response.results):
+            logging.getLogger(__name__).warning("number of page results wrong (%d != %d) ",
+                    response.number_of_page_results, len(response.results))
+        if isinstance(self, Search):
+            offset = response.offset
+        with self._lock:
+            end_result = offset + len(response.results)
+            if len(self._results) < end_result:
+                self._results.extend(
+                    [None] * (end_result - len(self._results)))
+            for j in range(offset, end_result):
+                self._results[j] = response.results[j-offset]
+            self._loaded_pages |= 1 << page
+
+    def _ensure_page(self, page):
+        with self._lock:
+            if self._page_loaded(page):
+                return
+            prefetch = self._prefetching.get(page)
+        if prefetch != None:
+            prefetch.join()
+            if self._page_loaded(page):
+                return
+        self._load_page(page)
+
+    def _prefetch(self, page):
+        """Loads page in the background, errors are left to _ensure_page."""
+        def _run():
+            try:
+                self._load_page(page)
+            except Exception:
+                logging.getLogger(__name__).debug(
+                        "Prefetching page %d failed", page, exc_info=True)
+            finally:
+                with self._lock:
+                    self._prefetching.pop(page, None)
+
+        with self._lock:
+            if self._page_loaded(page) or page in self._prefetching:
+                return
+            thread = threading.Thread(target=_run)
+            thread.daemon = True
+            self._prefetching[page] = thread
+        thread.start()
+
     def __getitem__(self, index):
         if isinstance(index, slice):
             start = index.start or 0
@@ -400,33 +704,14 @@ class _ListResource(_Resource):
         if start < 0 or start >= self._total or \
                 stop > self._total:
             raise IndexError('Index out of range')
-        if len(self._results) < stop or \
-                None in self._results[start:stop:step]:
-            for i in range(start, stop, 100):
-                response = self._request_object(
-                        limit=self._limit,
-                        offset=i,
-                        **self._args
-                    )
-                if response.number_of_page_results != len(response.results):
-                    logging.getLogger(__name__).warning("number of page results wrong (%d != %d) ",
-                            response.number_of_page_results, len(response.results))
-                if isinstance(self, Search):
-                    end_result = response.offset + response.number_of_page_results
-                    if len(self._results) < end_result:
-                        self._results.extend(
-                            [None] * (end_result - len(self._results)))
-                    for j in range(response.offset, 
-                                   response.offset+len(response.results)):
-                            self._results[j] = response.results[j-response.offset]
-                else:
-                    for j in range(
-                            len(self._results),
-                            i+response.number_of_page_results
-                        ):
-                        self._results.append(None)
-                    for j in range(i, i+response.number_of_page_results):
-                        self._results[j] = response.results[j-i]         
+        if step == 1:
+            pages = range(start / self._limit, (stop - 1) / self._limit + 1)
+        else:
+            pages = sorted(set(
+                    i / self._limit for i in range(start, stop, step)
+                ))
+        for page in pages:
+            self._ensure_page(page)
         if isinstance(self._results[index], list):
             if not isinstance(index, slice) and len(self._results[index]) == 0:
                 self._results[index] = None
@@ -441,6 +726,37 @@ class _ListResource(_Resource):
             self._parse_result(index)
         return self._results[index]
 
+    def pages(self, prefetch = True, max_results = None, retry = None):
+        """Yields the parsed resources page by page.
+
+        While a page is being consumed the next one is loaded in the
+        background if prefetch is set.  Iteration stops after
+        max_results resources.  retry, if given, is a decorator applied
+        to the page loads, e.g. to retry failed requests.
+        """
+        ensure_page = self._ensure_page
+        if retry != None:
+            ensure_page = retry(ensure_page)
+        total = self._total
+        if max_results != None:
+            total = min(total, max_results)
+        if total <= 0:
+            return
+        page_count = (total - 1) / self._limit + 1
+        for page in range(page_count):
+            if prefetch and page + 1 < page_count:
+                self._prefetch(page + 1)
+            ensure_page(page)
+            start = page * self._limit
+            stop = min(start + self._limit, total, len(self._results))
+            yield [self[i] for i in range(start, stop)]
+
+    def stream(self, prefetch = True, max_results = None, retry = None):
+        """Yields the parsed resources, loading pages ahead of use."""
+        for page in self.pages(prefetch, max_results, retry):
+            for resource in page:
+                yield resource
+
     def __iter__(self):
         for index in xrange(self._total):
             yield self[index]
@@ -506,10 +822,7 @@ class _SortableListResource(_ListResource):
     def search(type, query, **kwargs):
         if 'resources' in kwargs:
             del kwargs['resources']
-        types = Types()
-        resource_type = types[
-                Types.snakify_type_name(type)
-            ]['detail_resource_name']
+        resource_type = Types()[type]['detail_resource_name']
         return Search(query=query, resources=resource_type, **kwargs)
 
 class Character(_SingularResource):
@@ -909,34 +1222,138 @@ class Team(_SingularResource):
 class Teams(_SortableListResource):
     pass
 
+# Snapshot of the types/ endpoint, so the type table is available
+# without a request
+_TYPES_SNAPSHOT = [
+        {'id': 4005, 'detail_resource_name': 'character',
+         'list_resource_name': 'characters'},
+        {'id': 2450, 'detail_resource_name': 'chat',
+         'list_resource_name': 'chats'},
+        {'id': 4015, 'detail_resource_name': 'concept',
+         'list_resource_name': 'concepts'},
+        {'id': 4000, 'detail_resource_name': 'issue',
+         'list_resource_name': 'issues'},
+        {'id': 4020, 'detail_resource_name': 'location',
+         'list_resource_name': 'locations'},
+        {'id': 4025, 'detail_resource_name': 'movie',
+         'list_resource_name': 'movies'},
+        {'id': 4055, 'detail_resource_name': 'object',
+         'list_resource_name': 'objects'},
+        {'id': 4030, 'detail_resource_name': 'origin',
+         'list_resource_name': 'origins'},
+        {'id': 4040, 'detail_resource_name': 'person',
+         'list_resource_name': 'people'},
+        {'id': 4035, 'detail_resource_name': 'power',
+         'list_resource_name': 'powers'},
+        {'id': 1700, 'detail_resource_name': 'promo',
+         'list_resource_name': 'promos'},
+        {'id': 4010, 'detail_resource_name': 'publisher',
+         'list_resource_name': 'publishers'},
+        {'id': 4045, 'detail_resource_name': 'story_arc',
+         'list_resource_name': 'story_arcs'},
+        {'id': 4060, 'detail_resource_name': 'team',
+         'list_resource_name': 'teams'},
+        {'id': 2300, 'detail_resource_name': 'video',
+         'list_resource_name': 'videos'},
+        {'id': 2320, 'detail_resource_name': 'video_type',
+         'list_resource_name': 'video_types'},
+        {'id': 4050, 'detail_resource_name': 'volume',
+         'list_resource_name': 'volumes'},
+    ]
+
 class Types(_ListResource):
+    """Registry of the resource types of the API.
+
+    The table starts from _TYPES_SNAPSHOT, so resolving a type never
+    needs a request.  refresh() replaces it with the live types/
+    endpoint, in the background if asked to, and an unknown resource
+    name triggers one refresh before giving up.  Lookups by resource
+    class, detail or list resource name are dictionary lookups.
+    """
+
     def __new__(type):
         if not '_instance' in type.__dict__:
             type._instance = object.__new__(type)
         return type._instance
 
     def __init__(self):
-        if not '_ready' in dir(self):
-            super(Types, self).__init__()
-            self._mapping = {}
-            for type in self:
-                type['singular_resource_class'] = getattr(
-                        sys.modules[__name__],
-                        Types._camilify_type_name(
-                                type['detail_resource_name']),
-                        UnknownResource
-                    )
-                self._mapping[type['detail_resource_name']] = type
-                self._mapping[type['list_resource_name']] = type
+        if not '_ready' in self.__dict__:
+            super(Types, self).__init__(copy.deepcopy(_TYPES_SNAPSHOT))
+            self._refreshed = False
+            self._index()
             self._ready = True
 
+    def _index(self):
+        module = sys.modules[__name__]
+        mapping = {}
+        for type in self._results:
+            type['singular_resource_class'] = getattr(
+                    module,
+                    Types._camilify_type_name(type['detail_resource_name']),
+                    UnknownResource
+                )
+            mapping[type['detail_resource_name']] = type
+            mapping[type['list_resource_name']] = type
+            if type['singular_resource_class'] != UnknownResource:
+                mapping[type['singular_resource_class']] = type
+            list_class = getattr(
+                    module,
+                    Types._camilify_type_name(type['list_resource_name']),
+                    None
+                )
+            if list_class != None:
+                mapping[list_class] = type
+        self._mapping = mapping
+
+    def refresh(self, background = False):
+        """Reloads the type table from the types/ endpoint."""
+        if background:
+            thread = threading.Thread(target=self._refresh_quietly)
+            thread.daemon = True
+            thread.start()
+            return
+        response = self._request_object()
+        with self._lock:
+            self._results = response.results
+            self._total = len(response.results)
+            self._limit = len(response.results)
+            self._loaded_pages = 1
+            self._refreshed = True
+            self._index()
+
+    def _refresh_quietly(self):
+        try:
+            self.refresh()
+        except Exception:
+            logging.getLogger(__name__).warning(
+                    "Refreshing resource types failed", exc_info=True)
+
     def __getitem__(self, key):
         if isinstance(key, (int, long, slice)):
             return super(Types, self).__getitem__(key)
-        if isinstance(key, type):
-            return self._mapping[self.snakify_type_name(key)]
+        try:
+            return self._mapping[key]
+        except KeyError:
+            if isinstance(key, type):
+                # Classes outside of the table, e.g. user subclasses
+                type_dict = self._mapping[self.snakify_type_name(key)]
+                self._mapping[key] = type_dict
+                return type_dict
+            if self._refreshed:
+                raise
+        try:
+            self.refresh()
+        except Exception:
+            logging.getLogger(__name__).warning(
+                    "Refreshing resource types failed", exc_info=True)
+            self._refreshed = True
+            raise KeyError(key)
         return self._mapping[key]
 
+    def type_id(self, key):
+        """Type id of a resource class or resource name."""
+        return self[key]['id']
+
     @staticmethod
     def snakify_type_name(type):
         return re.sub(r'([A-Z]+)',r"_\1", type.__name__)[1:].lower()
@@ -0,0 +1,389 @@
+import collections
+import logging
+import os
+import threading
+import time
+from urllib import urlencode
+import urlparse
+import zlib
+
+# Resources that rarely change on the server can be kept for longer
+DEFAULT_TTLS = {
+        'issue': 60 * 60,
+        'person': 24 * 60 * 60,
+        'publisher': 7 * 24 * 60 * 60,
+        'volume': 24 * 60 * 60,
+    }
+
+class ResourceCache(object):
+    """Bounded LRU cache of resource objects with per type expiry.
+
+    Entries are keyed by "type_id-id" and tagged with the detail resource
+    name of their type (e.g. 'issue') which selects the TTL used.  A TTL
+    of None keeps entries until they are evicted.
+    """
+
+    def __init__(
+            self,
+            max_entries = 10000,
+            ttls = None,
+            default_ttl = 60 * 60,
+            clock = time.time
+        ):
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._clock = clock
+        self.max_entries = max_entries
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls != None:
+            self.ttls.update(ttls)
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def configure(self, max_entries = None, ttls = None):
+        with self._lock:
+            if max_entries != None:
+                self.max_entries = max_entries
+            if ttls != None:
+                self.ttls.update(ttls)
+            self._evict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry == None:
+                self.misses += 1
+                return None
+            expires, obj = entry
+            if expires != None and expires <= self._clock():
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return obj
+
+    def put(self, key, obj, resource_name = None):
+        ttl = self.ttls.get(resource_name, self.default_ttl)
+        with self._lock:
+            if ttl == None:
+                expires = None
+            else:
+                expires = self._clock() + ttl
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, obj)
+            self._evict()
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                    'entries': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                }
+
+    def _evict(self):
+        while self.max_entries != None and \
+                len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+# Freshness of cached API responses in seconds, by endpoint
+DEFAULT_RESPONSE_TTLS = {
+        'issue': 6 * 60 * 60,
+        'issues': 6 * 60 * 60,
+        'people': 7 * 24 * 60 * 60,
+        'person': 7 * 24 * 60 * 60,
+        'publisher': 7 * 24 * 60 * 60,
+        'search': 24 * 60 * 60,
+        'types': 30 * 24 * 60 * 60,
+        'volume': 24 * 60 * 60,
+        'volumes': 24 * 60 * 60,
+    }
+
+# Resources tracked for invalidation, by the endpoint returning them
+RESOURCE_ENDPOINTS = {
+        'issue': 'issue',
+        'issues': 'issue',
+        'volume': 'volume',
+        'volumes': 'volume',
+    }
+
+class ResponseCache(object):
+    """Persistent cache of raw API responses stored in SQLite.
+
+    Responses are keyed on the request URL with the api_key removed and
+    the remaining parameters sorted, and are stored zlib compressed.
+    Entries older than the TTL of their endpoint are stale; stale entries
+    younger than twice the TTL are still served while revalidate() fetches
+    a replacement in the background.  When the stored bytes exceed
+    max_bytes the least recently used responses are removed.  Access
+    times are kept in memory and written with the next put(), or at most
+    every flush_interval seconds, so cache hits do not write to disk.
+
+    Responses can be tagged with the resources they contain (e.g.
+    'issue-6') and the date_last_updated they were returned with, so
+    invalidate() can drop every response holding an outdated copy of a
+    resource.
+    """
+
+    def __init__(
+            self,
+            path,
+            max_bytes = 50 * 1024 * 1024,
+            ttls = None,
+            default_ttl = 24 * 60 * 60,
+            flush_interval = 60,
+            clock = time.time
+        ):
+        # sqlite3 is slow to import, so it is only loaded with a cache
+        import sqlite3
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.ttls = dict(DEFAULT_RESPONSE_TTLS)
+        if ttls != None:
+            self.ttls.update(ttls)
+        self.default_ttl = default_ttl
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._revalidating = set()
+        self._accessed = {}
+        self._flushed = clock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(path, timeout=30,
+                                   check_same_thread=False)
+        with self._lock:
+            self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, endpoint TEXT, body BLOB, "
+                    "size INTEGER, stored REAL, accessed REAL)"
+                )
+            self._db.execute(
+                    "CREATE INDEX IF NOT EXISTS responses_accessed "
+                    "ON responses (accessed)"
+                )
+            self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS resources ("
+                    "resource TEXT, key TEXT, updated TEXT, "
+                    "PRIMARY KEY (resource, key))"
+                )
+            self._db.execute(
+                    "CREATE INDEX IF NOT EXISTS resources_key "
+                    "ON resources (key)"
+                )
+            self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS state ("
+                    "name TEXT PRIMARY KEY, value TEXT)"
+                )
+            self._db.commit()
+
+    @staticmethod
+    def key(url):
+        parts = urlparse.urlsplit(url)
+        params = sorted(
+                (name, value)
+                for name, value in urlparse.parse_qsl(parts.query, True)
+                if name != 'api_key'
+            )
+        path = parts.path
+        if path.startswith('/api/'):
+            path = path[len('/api/'):]
+        return path.lstrip('/') + '?' + urlencode(params)
+
+    @staticmethod
+    def endpoint(key):
+        return key.split('/', 1)[0].split('?', 1)[0]
+
+    def ttl(self, key):
+        return self.ttls.get(self.endpoint(key), self.default_ttl)
+
+    def get(self, key):
+        """Returns (body, fresh) or (None, False) if not usable."""
+        now = self._clock()
+        with self._lock:
+            row = self._db.execute(
+                    "SELECT body, stored FROM responses WHERE key = ?",
+                    (key,)
+                ).fetchone()
+            if row == None:
+                return None, False
+            body, stored = row
+            age = now - stored
+            ttl = self.ttl(key)
+            if age > 2 * ttl:
+                return None, False
+            self._accessed[key] = now
+            if now - self._flushed >= self.flush_interval:
+                self.flush()
+        return zlib.decompress(body), age <= ttl
+
+    def put(self, key, body, resources = None):
+        """Store body, tagged with a {resource: updated} dict."""
+        import sqlite3
+        data = sqlite3.Binary(zlib.compress(body))
+        now = self._clock()
+        with self._lock:
+            self._db.execute(
+                    "INSERT OR REPLACE INTO responses "
+                    "(key, endpoint, body, size, stored, accessed) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, self.endpoint(key), data, len(data), now, now)
+                )
+            self._db.execute("DELETE FROM resources WHERE key = ?", (key,))
+            self._accessed.pop(key, None)
+            if resources:
+                self._db.executemany(
+                        "INSERT OR REPLACE INTO resources "
+                        "(resource, key, updated) VALUES (?, ?, ?)",
+                        [
+                            (resource, key, updated)
+                            for resource, updated in resources.items()
+                        ]
+                    )
+            self._flush_accessed()
+            self._evict()
+            self._db.commit()
+
+    def flush(self):
+        """Write the access times of recent cache hits."""
+        with self._lock:
+            self._flush_accessed()
+            self._db.commit()
+
+    def _flush_accessed(self):
+        if self._accessed:
+            self._db.executemany(
+                    "UPDATE responses SET accessed = ? WHERE key = ?",
+                    [(accessed, key)
+                     for key, accessed in self._accessed.items()]
+                )
+            self._accessed.clear()
+        self._flushed = self._clock()
+
+    def invalidate(self, resource, updated = None):
+        """Drop responses holding resource as of before updated.
+
+        Returns the number of responses removed.
+        """
+        with self._lock:
+            keys = [
+                    key for (key,) in self._db.execute(
+                        "SELECT key FROM resources WHERE resource = ? AND "
+                        "(? IS NULL OR updated IS NULL OR updated < ?)",
+                        (resource, updated, updated)
+                    ).fetchall()
+                ]
+            for key in keys:
+                self._delete(key)
+            self._db.commit()
+        return len(keys)
+
+    def oldest(self):
+        """Time the oldest response was stored, None if empty."""
+        with self._lock:
+            return self._db.execute(
+                    "SELECT MIN(stored) FROM responses"
+                ).fetchone()[0]
+
+    def state(self, name):
+        with self._lock:
+            row = self._db.execute(
+                    "SELECT value FROM state WHERE name = ?", (name,)
+                ).fetchone()
+        if row == None:
+            return None
+        return row[0]
+
+    def set_state(self, name, value):
+        with self._lock:
+            self._db.execute(
+                    "INSERT OR REPLACE INTO state (name, value) "
+                    "VALUES (?, ?)",
+                    (name, value)
+                )
+            self._db.commit()
+
+    def revalidate(self, key, refresh):
+        """Run refresh() in the background unless already running."""
+        with self._lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+
+        def _run():
+            try:
+                refresh()
+            except Exception:
+                logging.getLogger(__name__).warning(
+                        "Revalidating %s failed", key, exc_info=True)
+            finally:
+                with self._lock:
+                    self._revalidating.discard(key)
+
+        thread = threading.Thread(target=_run, name='revalidate ' + key)
+        thread.daemon = True
+        thread.start()
+
+    def discard(self, key):
+        with self._lock:
+            self._delete(key)
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.execute("DELETE FROM resources")
+            self._accessed.clear()
+            self._db.commit()
+
+    def _delete(self, key):
+        self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self._db.execute("DELETE FROM resources WHERE key = ?", (key,))
+        self._accessed.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db.execute(
+                    "SELECT COUNT(*), TOTAL(size) FROM responses"
+                ).fetchone()
+        return {'entries': entries, 'bytes': int(size)}
+
+    def _evict(self):
+        if self.max_bytes == None:
+            return
+        size = self._db.execute(
+                "SELECT TOTAL(size) FROM responses"
+            ).fetchone()[0]
+        if size <= self.max_bytes:
+            return
+        rows = self._db.execute(
+                "SELECT key, size FROM responses ORDER BY accessed"
+            ).fetchall()
+        for key, entry_size in rows:
+            if size <= self.max_bytes:
+                break
+            self._delete(key)
+            size -= entry_size
@@ -0,0 +1,172 @@
+import logging
+import Queue
+import sys
+import threading
+import time
+
+class CancelledError(Exception):
+    pass
+
+class TimeoutError(Exception):
+    pass
+
+class Future(object):
+    """Result of a call running on a Client."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._cancelled = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def cancel(self):
+        with self._condition:
+            if self._done:
+                return False
+            self._cancelled = True
+        self._finish()
+        return True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout = None):
+        self._wait(timeout)
+        if self._exc_info != None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout = None):
+        self._wait(timeout)
+        if self._exc_info != None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, callback):
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _wait(self, timeout):
+        with self._condition:
+            if timeout == None:
+                while not self._done:
+                    self._condition.wait()
+            else:
+                deadline = time.time() + timeout
+                while not self._done:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise TimeoutError()
+                    self._condition.wait(remaining)
+            if self._cancelled:
+                raise CancelledError()
+
+    def _finish(self):
+        with self._condition:
+            if self._done:
+                return
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+            self._condition.notify_all()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logging.getLogger(__name__).exception(
+                        "Future callback %r failed", callback)
+
+def wait(futures, timeout = None):
+    """Waits for all futures, returns the ones not done by timeout."""
+    deadline = None
+    if timeout != None:
+        deadline = time.time() + timeout
+    pending = []
+    for future in futures:
+        try:
+            if deadline == None:
+                future.exception()
+            else:
+                future.exception(max(0, deadline - time.time()))
+        except TimeoutError:
+            pending.append(future)
+        except CancelledError:
+            pass
+    return pending
+
+class Client(object):
+    """Concurrent front end to the blocking resource API.
+
+    Calls are queued to a fixed pool of worker threads, so any number of
+    outstanding lookups share pool_size threads, the pooled transport and
+    the rate limiting hooks of the blocking API.  Every method returns a
+    Future.
+    """
+
+    def __init__(self, workers = 4):
+        self._workers = workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def configure(self, workers):
+        with self._lock:
+            self._workers = workers
+            self._start()
+
+    def submit(self, function, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            self._start()
+        self._queue.put((future, function, args, kwargs))
+        return future
+
+    def map(self, function, iterable):
+        return [self.submit(function, item) for item in iterable]
+
+    def singular(self, resource_class, id, **kwargs):
+        return self.submit(resource_class, id, **kwargs)
+
+    def list(self, resource_class, **kwargs):
+        return self.submit(resource_class, **kwargs)
+
+    def search(self, resource_class, query, **kwargs):
+        return self.submit(resource_class.search, query, **kwargs)
+
+    def _start(self):
+        self._threads = [
+                thread for thread in self._threads if thread.is_alive()
+            ]
+        for _ in range(len(self._threads), self._workers):
+            thread = threading.Thread(
+                    target=self._work,
+                    name='pycomicvine worker'
+                )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            future, function, args, kwargs = self._queue.get()
+            if future.cancelled():
+                continue
+            try:
+                future.set_result(function(*args, **kwargs))
+            except:
+                future.set_exception(sys.exc_info())
@@ -0,0 +1,118 @@
+import datetime
+import logging
+import time
+
+from . import Issue, Issues, Types, Volume, Volumes
+
+# Format of date_last_updated in responses and list filters
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# date_last_updated is in the server's time zone, so windows of changes
+# are widened by a day around UTC
+ZONE_MARGIN = datetime.timedelta(days=1)
+
+def window_end():
+    """End of a date_last_updated filter window reaching the present."""
+    return datetime.datetime.utcnow() + ZONE_MARGIN
+
+class CacheSync(object):
+    """Keeps cached issues and volumes in step with the server.
+
+    Every sync asks the issues and volumes lists for what changed since
+    the last sync (filter=date_last_updated:start|end, oldest first) and
+    drops cached responses and resource objects holding an older copy.
+    Only ids and dates are requested, so a page of 100 changes costs one
+    request however many of them are cached.  The position in each list
+    is saved after every page, so syncs limited to max_pages continue
+    where the previous one stopped.
+
+    With the cache kept in sync, issue and volume responses can be given
+    long TTLs (see SYNCED_TTLS).
+    """
+
+    RESOURCES = (
+            ('issue', Issue, Issues),
+            ('volume', Volume, Volumes),
+        )
+
+    def __init__(self, response_cache, resource_cache = None,
+                 max_pages = 10, clock = time.time):
+        self.response_cache = response_cache
+        self.resource_cache = resource_cache
+        self.max_pages = max_pages
+        self._clock = clock
+
+    def due(self, interval):
+        """True if no sync was started in the last interval seconds."""
+        started = self.response_cache.state('sync_started')
+        return started == None or \
+                self._clock() - float(started) >= interval
+
+    def _since(self, name):
+        since = self.response_cache.state('sync_' + name)
+        if since == None:
+            # Nothing older than the oldest response needs checking
+            oldest = self.response_cache.oldest()
+            if oldest == None:
+                return None
+            since = (
+                    datetime.datetime.utcfromtimestamp(oldest) -
+                    ZONE_MARGIN
+                ).strftime(DATE_FORMAT)
+        return since
+
+    def sync(self, until = None):
+        """Invalidate changed resources, returns the number invalidated."""
+        if until == None:
+            until = window_end()
+        self.response_cache.set_state('sync_started', repr(self._clock()))
+        invalidated = 0
+        for name, singular, plural in self.RESOURCES:
+            since = self._since(name)
+            if since == None:
+                continue
+            type_id = Types().type_id(singular)
+            changes = plural(
+                    filter='date_last_updated:{0}|{1}'.format(
+                            since,
+                            until.strftime(DATE_FORMAT)
+                        ),
+                    sort='date_last_updated:asc',
+                    field_list=['id', 'date_last_updated'],
+                    # The window ends at the current time, so the
+                    # response could never be used again
+                    cache=False
+                )
+            pages = 0
+            for page in changes.pages(prefetch=False):
+                for resource in page:
+                    if not resource:
+                        continue
+                    updated = resource.date_last_updated
+                    if isinstance(updated, datetime.datetime):
+                        updated = updated.strftime(DATE_FORMAT)
+                    invalidated += self.response_cache.invalidate(
+                            "{0}-{1}".format(name, resource.id),
+                            updated
+                        )
+                    if self.resource_cache != None:
+                        self.resource_cache.discard("{0:d}-{1:d}".format(
+                                type_id,
+                                resource.id
+                            ))
+                    since = max(since, updated)
+                self.response_cache.set_state('sync_' + name, since)
+                pages += 1
+                if pages >= self.max_pages:
+                    break
+        logging.getLogger(__name__).info(
+                "Cache sync invalidated %d responses", invalidated)
+        return invalidated
+
+# Issue and volume TTLs for response caches kept up to date by CacheSync
+SYNCED_TTLS = {
+        'issue': 30 * 24 * 60 * 60,
+        'issues': 30 * 24 * 60 * 60,
+        'volume': 30 * 24 * 60 * 60,
+        'volumes': 30 * 24 * 60 * 60,
+    }
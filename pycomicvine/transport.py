@@ -0,0 +1,173 @@
+import base64
+import httplib
+import socket
+import threading
+import urllib
+import urllib2
+import urlparse
+import zlib
+
+_MAX_REDIRECTS = 5
+
+class HTTPTransport(object):
+    """Thread safe HTTP client keeping persistent connections per host.
+
+    At most pool_size connections are open to any one host; callers block
+    until one is free.  Responses are requested gzip encoded and are
+    returned decoded.  Proxies configured in the environment or the
+    system settings (as found by urllib.getproxies) are used, tunnelling
+    HTTPS requests through them.  Any object with a compatible fetch()
+    method can be installed with pycomicvine.set_transport() instead,
+    e.g. to talk to a local stub server.
+    """
+
+    def __init__(self, pool_size = 4, user_agent = 'pycomicvine'):
+        self.pool_size = pool_size
+        self.user_agent = user_agent
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def configure(self, pool_size):
+        with self._lock:
+            if pool_size == self.pool_size:
+                return
+            self.pool_size = pool_size
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            self._close_idle(pool)
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            self._close_idle(pool)
+
+    def fetch(self, url, timeout = None):
+        for _ in range(_MAX_REDIRECTS + 1):
+            status, reason, headers, body = self._get(url, timeout)
+            if status in (301, 302, 303, 307, 308) and \
+                    headers.get('location'):
+                url = urlparse.urljoin(url, headers['location'])
+                continue
+            if status != 200:
+                raise urllib2.HTTPError(url, status, reason, headers, None)
+            if headers.get('content-encoding') == 'gzip':
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            return body
+        raise urllib2.HTTPError(url, status, 'Too many redirects',
+                                headers, None)
+
+    def _get(self, url, timeout):
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        slots, idle, proxy = self._pool(parts.scheme, parts.netloc)
+        request_headers = {}
+        if proxy != None and parts.scheme == 'http':
+            # Plain requests are sent to the proxy with the full URL
+            path = url
+            request_headers = proxy[1]
+        slots.acquire()
+        try:
+            try:
+                connection = idle.pop()
+            except IndexError:
+                connection = None
+            try:
+                if connection == None:
+                    connection = self._connect(
+                            parts.scheme, parts.netloc, proxy, timeout)
+                    response = self._send(
+                            connection, path, request_headers, timeout)
+                else:
+                    try:
+                        response = self._send(
+                                connection, path, request_headers, timeout)
+                    except (httplib.HTTPException, socket.error):
+                        # The server may have dropped the idle connection
+                        connection.close()
+                        connection = self._connect(
+                                parts.scheme, parts.netloc, proxy, timeout)
+                        response = self._send(
+                                connection, path, request_headers, timeout)
+                response_headers = dict(
+                        (name.lower(), value)
+                        for name, value in response.getheaders()
+                    )
+                body = response.read()
+            except:
+                if connection != None:
+                    connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                idle.append(connection)
+        finally:
+            slots.release()
+        return response.status, response.reason, response_headers, body
+
+    def _send(self, connection, path, headers, timeout):
+        if connection.sock != None:
+            connection.sock.settimeout(timeout)
+        headers = dict(headers)
+        headers.update({
+                'Accept-Encoding': 'gzip',
+                'User-Agent': self.user_agent,
+            })
+        connection.request('GET', path, headers=headers)
+        return connection.getresponse()
+
+    def _connect(self, scheme, netloc, proxy, timeout):
+        if proxy != None:
+            proxy_netloc, proxy_headers = proxy
+            if scheme == 'https':
+                connection = httplib.HTTPSConnection(
+                        proxy_netloc, timeout=timeout)
+                connection.set_tunnel(netloc, headers=proxy_headers)
+                return connection
+            return httplib.HTTPConnection(proxy_netloc, timeout=timeout)
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=timeout)
+        return httplib.HTTPConnection(netloc, timeout=timeout)
+
+    @staticmethod
+    def _proxy(scheme, netloc):
+        """(proxy netloc, proxy headers) for a host, None if direct."""
+        proxy = urllib.getproxies().get(scheme)
+        if proxy == None or urllib.proxy_bypass(netloc.split(':')[0]):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urlparse.urlsplit(proxy)
+        proxy_netloc = parts.hostname
+        if parts.port != None:
+            proxy_netloc += ':{0:d}'.format(parts.port)
+        headers = {}
+        if parts.username != None:
+            credentials = '{0}:{1}'.format(
+                    urllib.unquote(parts.username),
+                    urllib.unquote(parts.password or '')
+                )
+            headers['Proxy-Authorization'] = \
+                    'Basic ' + base64.b64encode(credentials)
+        return proxy_netloc, headers
+
+    def _pool(self, scheme, netloc):
+        with self._lock:
+            pool = self._pools.get((scheme, netloc))
+            if pool == None:
+                pool = (
+                        threading.Semaphore(self.pool_size),
+                        [],
+                        self._proxy(scheme, netloc)
+                    )
+                self._pools[(scheme, netloc)] = pool
+            return pool
+
+    @staticmethod
+    def _close_idle(pool):
+        idle = pool[1]
+        while len(idle) > 0:
+            idle.pop().close()
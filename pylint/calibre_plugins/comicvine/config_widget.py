@@ -0,0 +1 @@
+../../../config_widget.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../../covercache.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../../ranking.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../../ratelimit.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../../volumeindex.py
\ No newline at end of file
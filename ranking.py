@@ -0,0 +1,96 @@
+'''
+calibre_plugins.comicvine - identify result ranking
+'''
+from calibre_plugins.comicvine import utils
+
+# Feature weights, in the order returned by RankingEngine.features
+WEIGHTS = (
+  1,  # years between publication date and year in title
+  1,  # difference in length of volume and title
+  10, # title tokens missing from the volume
+  1,  # 100 - Levenshtein ratio percentage
+  50, # issue number mismatch
+  10, # issue number missing from the title
+  50, # collected edition
+  10, # authors missing from the result
+)
+
+class RankingEngine(object):
+  '''
+  Implement multi-result comparisons.
+
+  Every similarity feature of a result is computed once and the score is
+  the weighted sum of the features:
+
+  1. Prefer an entry where the comicvine id matches
+  2. Prefer similar titles using Levenshtein ratio
+  3. Penalise entries where the issue number is not in the title
+  4. Prefer matching authors (the more matches, the higher the preference)
+
+  With legacy set the title similarity is weighted once per title token,
+  reproducing the ordering of the original keygen.  Instances are usable
+  as the key function of identify_results_keygen.
+  '''
+  def __init__(self, title=None, authors=None, identifiers=None,
+               issue_number=None, title_tokens=None, legacy=True):
+    self.title = title
+    self.authors = authors or []
+    self.identifier = (identifiers or {}).get('comicvine')
+    self.issue_number = issue_number
+    self.title_tokens = title_tokens or []
+    weights = list(WEIGHTS)
+    if legacy:
+      weights[3] *= len(self.title_tokens)
+    self.weights = tuple(weights)
+
+  def matches_identifier(self, metadata):
+    'Check whether result has the comicvine id being searched for'
+    if self.identifier is None:
+      return False
+    try:
+      return metadata.get_identifier('comicvine') == self.identifier
+    except AttributeError:
+      return False
+
+  def features(self, metadata):
+    'Compute the ranking features of a result'
+    title_features = (0, 0, 0, 0, 0, 0, 0)
+    if self.title:
+      (volume, is_collection) = utils.metadata_inputs(metadata)
+      (title, year) = utils.title_inputs(self.title)
+      if year is None:
+        year_distance = 0
+      elif metadata.pubdate:
+        year_distance = abs(metadata.pubdate.year - year)
+      else:
+        year_distance = 10 # penalise entries with no publication date
+      title_features = (
+        year_distance,
+        abs(len(volume) - len(title)),
+        len([token for token in self.title_tokens if token not in volume]),
+        100 - int(100 * utils.similarity(volume, title)),
+        int(self.issue_number is not None and
+            metadata.series_index != self.issue_number),
+        int(metadata.series_index not in title),
+        int(is_collection),
+      )
+    missing_authors = len([author for author in self.authors
+                           if author not in metadata.authors])
+    return title_features + (missing_authors,)
+
+  def __call__(self, metadata):
+    if self.matches_identifier(metadata):
+      return 0
+    return sum(weight * feature for weight, feature
+               in zip(self.weights, self.features(metadata)))
+
+  def rank(self, results):
+    'Score every result'
+    return [self(metadata) for metadata in results]
+
+  def sort(self, results):
+    'Return results in ranking order'
+    results = list(results)
+    scores = self.rank(results)
+    return [metadata for _, _, metadata in sorted(
+      zip(scores, range(len(results)), results))]
@@ -0,0 +1,245 @@
+'''
+calibre_plugins.comicvine - API request rate limiting
+'''
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+try:
+  import msvcrt
+except ImportError:
+  msvcrt = None
+
+try:
+  monotonic = time.monotonic # pylint: disable=E1101
+except AttributeError:
+  monotonic = time.time
+
+class FileLock(object):
+  '''Advisory lock on a file shared between processes'''
+  def __init__(self, path):
+    self.path = path
+    self.handle = None
+
+  def __enter__(self):
+    self.handle = open(self.path, 'a+')
+    if fcntl:
+      fcntl.lockf(self.handle, fcntl.LOCK_EX)
+    elif msvcrt:
+      self.handle.seek(0)
+      msvcrt.locking(self.handle.fileno(), msvcrt.LK_LOCK, 1)
+    return self
+
+  def __exit__(self, *exc_info):
+    if fcntl:
+      fcntl.lockf(self.handle, fcntl.LOCK_UN)
+    elif msvcrt:
+      self.handle.seek(0)
+      msvcrt.locking(self.handle.fileno(), msvcrt.LK_UNLCK, 1)
+    self.handle.close()
+    self.handle = None
+
+class SharedTokenBucket(object):
+  '''Token bucket shared by every process using the same state_path.
+
+  The bucket state (tokens, last update) is kept in a small memory
+  mapped file and updated under an exclusive lock file, so all calibre
+  worker processes draw from one budget.  Tokens are reserved in the
+  order processes take the lock, and the wait happens outside of it.
+  Wall clock time is used since it is the only clock shared between
+  processes.
+  '''
+  STATE = struct.Struct('<dd')
+
+  def __init__(self, rate, burst, state_path, clock=time.time,
+               sleep=time.sleep):
+    self.lock = threading.Lock()
+    self.rate = float(rate)
+    self.burst = float(burst)
+    self.clock = clock
+    self.sleep = sleep
+    self.file_lock = FileLock(state_path + '.lock')
+    with self.file_lock:
+      handle = open(state_path, 'a+b')
+      if os.path.getsize(state_path) < self.STATE.size:
+        handle.write(self.STATE.pack(0.0, clock()))
+        handle.flush()
+      self.handle = handle
+      self.state = mmap.mmap(handle.fileno(), self.STATE.size)
+
+  def configure(self, rate=None, burst=None):
+    'Change the refill rate or burst size'
+    with self.lock:
+      if rate is not None:
+        self.rate = float(rate)
+      if burst is not None:
+        self.burst = float(burst)
+
+  def _update(self, consume, limit=None):
+    with self.lock:
+      with self.file_lock:
+        tokens, update = self.STATE.unpack(self.state[:self.STATE.size])
+        now = self.clock()
+        elapsed = now - update
+        if elapsed > 0:
+          tokens = min(self.burst, tokens + elapsed * self.rate)
+        tokens -= consume
+        if limit is not None:
+          tokens = min(tokens, limit)
+        self.state[:self.STATE.size] = self.STATE.pack(tokens, now)
+    return tokens
+
+  def pause(self, seconds):
+    'Hold back the next token in every process for at least seconds'
+    self._update(0, limit=-seconds * self.rate)
+
+  def consume(self):
+    'Take a token, sleeping until one is available'
+    tokens = self._update(1)
+    if tokens < 0:
+      wait = -tokens / self.rate
+      logging.warn('Slow down cowboy: %0.2f seconds to next token', wait)
+      self.sleep(wait)
+
+  @property
+  def tokens(self):
+    'Currently available tokens'
+    return self._update(0)
+
+  def close(self):
+    'Release the shared state'
+    self.state.close()
+    self.handle.close()
+
+class AdaptiveRate(object):
+  '''AIMD controller for the request rate of a token bucket.
+
+  Every successful response raises the rate by a small step until it
+  reaches max_rate.  A rate limit response (status 107) halves the rate
+  and pauses the bucket, doubling the pause for consecutive throttles.
+  Requests in flight together are all throttled at once, so further
+  rate limit responses arriving before the pause (or cooldown, if
+  longer) has passed belong to the same throttle and are ignored.
+  Responses much slower than the running average latency also reduce
+  the rate, at most once per cooldown seconds.
+  '''
+  RATE_LIMITED = 107
+
+  def __init__(self, bucket, max_rate, min_rate=None, pause=60.0,
+               max_pause=900.0, latency_factor=3.0, cooldown=30.0,
+               clock=monotonic):
+    self.lock = threading.Lock()
+    self.bucket = bucket
+    self.max_rate = float(max_rate)
+    self.min_rate = float(min_rate or max_rate / 16.0)
+    self.step = self.max_rate / 50
+    self.rate = self.max_rate
+    self.pause_time = pause
+    self.max_pause = max_pause
+    self.latency_factor = latency_factor
+    self.cooldown = cooldown
+    self.clock = clock
+    self.latency = None
+    self.throttles = 0
+    self._decreased = None
+    self._throttled_until = None
+
+  def _set_rate(self, rate):
+    self.rate = max(self.min_rate, min(self.max_rate, rate))
+    self.bucket.configure(rate=self.rate)
+
+  def throttled(self):
+    'Back off after the server reported the rate limit was exceeded'
+    with self.lock:
+      now = self.clock()
+      if self._throttled_until is not None and now < self._throttled_until:
+        return
+      self.throttles += 1
+      self._set_rate(self.rate / 2)
+      self._decreased = now
+      pause = min(self.max_pause,
+                  self.pause_time * 2 ** (self.throttles - 1))
+      self._throttled_until = now + max(pause, self.cooldown)
+    logging.warn('Rate limited by server, pausing requests for %d seconds '
+                 '(rate now %0.3f/s)', pause, self.rate)
+    self.bucket.pause(pause)
+
+  def response(self, status_code, elapsed):
+    'Adjust the rate after a response with status_code taking elapsed'
+    if status_code == self.RATE_LIMITED:
+      self.throttled()
+      return
+    with self.lock:
+      now = self.clock()
+      if self._throttled_until is not None and now < self._throttled_until:
+        # Requests sent before the throttle say nothing about the rate
+        return
+      self.throttles = 0
+      slow = (self.latency is not None and
+              elapsed > self.latency * self.latency_factor)
+      if self.latency is None:
+        self.latency = elapsed
+      else:
+        self.latency += 0.1 * (elapsed - self.latency)
+      if slow:
+        if self._decreased is None or now - self._decreased > self.cooldown:
+          self._decreased = now
+          self._set_rate(self.rate * 0.8)
+      elif self.rate < self.max_rate:
+        self._set_rate(self.rate + self.step)
+
+def _stress_worker(state_path, rate, burst, requests, speedup, start, results):
+  'Consume tokens from a shared bucket using an accelerated clock'
+  clock = lambda: start + (time.time() - start) * speedup
+  sleep = lambda seconds: time.sleep(seconds / speedup)
+  bucket = SharedTokenBucket(rate, burst, state_path, clock=clock,
+                             sleep=sleep)
+  for _ in range(requests):
+    bucket.consume()
+    results.put(clock())
+  bucket.close()
+
+def stress_test(processes=8, requests=25, rate=0.1, burst=10, speedup=200.0):
+  '''Run processes against one shared bucket and report the achieved rate.
+
+  The clock runs speedup times faster than real time so the default
+  0.1 requests/second limit can be exercised in a few seconds.
+  '''
+  import multiprocessing
+  import shutil
+  import tempfile
+  directory = tempfile.mkdtemp()
+  state_path = os.path.join(directory, 'tokens')
+  start = time.time()
+  try:
+    # Create the state before the workers start the clock running
+    SharedTokenBucket(rate, burst, state_path, clock=lambda: start).close()
+    results = multiprocessing.Queue()
+    workers = [
+      multiprocessing.Process(
+        target=_stress_worker,
+        args=(state_path, rate, burst, requests, speedup, start, results))
+      for _ in range(processes)]
+    for worker in workers:
+      worker.start()
+    times = sorted(results.get() for _ in range(processes * requests))
+    for worker in workers:
+      worker.join()
+  finally:
+    shutil.rmtree(directory)
+  # The initial bucket is empty, so every request waits for a token
+  achieved = (len(times) - 1) / (times[-1] - times[0])
+  return achieved
+
+if __name__ == '__main__':
+  ACHIEVED = stress_test()
+  print 'configured rate: %0.3f/s, achieved rate: %0.3f/s' % (0.1, ACHIEVED)
+  if abs(ACHIEVED - 0.1) > 0.01:
+    raise SystemExit('achieved rate outside of 10% tolerance')
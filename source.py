@@ -4,19 +4,32 @@ calibre_plugins.comicvine - A calibre metadata source for comicvine
 #pylint: disable-msg=R0913,R0904
 from functools import partial
 import logging
-from multiprocessing.pool import ThreadPool
-from Queue import Queue
+from Queue import Empty, Queue
 import threading
+import time
 
-from calibre import setup_cli_handlers
-from calibre.ebooks.metadata.opf2 import metadata_to_opf
 from calibre.ebooks.metadata.sources.base import Source
-from calibre.utils.config import OptionParser
 import calibre.utils.logging as calibre_logging
 from calibre_plugins.comicvine import pycomicvine
-from calibre_plugins.comicvine.config import PREFS
+from calibre_plugins.comicvine.pycomicvine.futures import (Client,
+                                                           TimeoutError)
+from calibre_plugins.comicvine.config import (PREFS, COVER_CACHE_PATH,
+                                              TOKEN_STATE_PATH,
+                                              VOLUME_INDEX_PATH,
+                                              configure_transport,
+                                              install_response_cache)
+from calibre_plugins.comicvine.ranking import RankingEngine
+from calibre_plugins.comicvine.ratelimit import (AdaptiveRate,
+                                                 SharedTokenBucket)
 from calibre_plugins.comicvine import utils
 
+# Bytes read from a cover download at a time
+COVER_CHUNK_SIZE = 64 * 1024
+
+# Seconds before the first and between later runs of the background jobs
+BACKGROUND_DELAY = 60
+BACKGROUND_INTERVAL = 5 * 60
+
 class Comicvine(Source):
   ''' Metadata source implementation '''
   name = 'Comicvine'
@@ -40,11 +53,127 @@ class Comicvine(Source):
     Source.__init__(self, *args, **kwargs)
 
   def initialize(self):
-    self.token_bucket = utils.TokenBucket()
-    pycomicvine.hook_register('pre_request_hook', self.token_bucket.consume)
+    # The token bucket, response cache and background jobs are set up on
+    # first use, so loading the plugin stays cheap for processes that
+    # never make a request
+    self._start_lock = threading.RLock()
+    self._started = False
+    self.token_bucket = None
+    self.rate_control = None
+    self.volume_index = None
+    self.cache_sync = None
+    self.cover_cache = None
+    self._background = threading.local()
+    pycomicvine.hook_register('pre_request_hook', self.consume_token)
+    pycomicvine.hook_register('post_request_hook', self.request_done)
+    cache = pycomicvine.resource_cache()
+    cache.configure(max_entries=PREFS['resource_cache_size'])
+    cache.clear()
+    self.client = Client(PREFS['worker_threads'])
+
+  def consume_token(self):
+    'Wait for a request token, creating the shared bucket on first use'
+    if self.token_bucket is None:
+      with self._start_lock:
+        if self.token_bucket is None:
+          bucket = SharedTokenBucket(
+            PREFS['requests_rate'], PREFS['requests_burst'],
+            TOKEN_STATE_PATH)
+          self.rate_control = AdaptiveRate(bucket, PREFS['requests_rate'])
+          self.token_bucket = bucket
+    if getattr(self._background, 'active', False):
+      self.wait_for_spare_tokens()
+    self.token_bucket.consume()
+
+  def wait_for_spare_tokens(self):
+    '''Hold a background request back until tokens are to spare
+
+    Half of the burst is kept for interactive requests, so identify and
+    cover downloads in every process go ahead of background jobs.
+    '''
+    reserve = PREFS['requests_burst'] / 2.0
+    while True:
+      tokens = self.token_bucket.tokens
+      if tokens >= reserve:
+        return
+      time.sleep((reserve - tokens) / self.token_bucket.rate)
+
+  def request_done(self, status_code, elapsed):
+    'Adjust the request rate after a response'
+    if self.rate_control is not None:
+      self.rate_control.response(status_code, elapsed)
+
+  def start(self):
+    'Set up the response cache, volume index and background jobs once'
+    with self._start_lock:
+      if self._started:
+        return
+      self._started = True
+      install_response_cache()
+      configure_transport()
+      if PREFS['cover_cache_size']:
+        from calibre_plugins.comicvine.covercache import CoverCache
+        self.cover_cache = CoverCache(
+          COVER_CACHE_PATH, max_bytes=PREFS['cover_cache_size'] * 1024 * 1024)
+      if PREFS['volume_index']:
+        self.start_volume_index()
+      if PREFS['cache_sync'] and pycomicvine.response_cache() is not None:
+        self.start_cache_sync()
+      if self.volume_index is not None or self.cache_sync is not None:
+        jobs = threading.Thread(
+          target=self.run_background_jobs, name='comicvine background jobs')
+        jobs.daemon = True
+        jobs.start()
+
+  def start_volume_index(self):
+    'Open the volume index'
+    from calibre_plugins.comicvine.volumeindex import VolumeIndex
+    self.volume_index = VolumeIndex(VOLUME_INDEX_PATH, self.index_tokens)
+
+  def start_cache_sync(self):
+    'Set up syncing of the response cache'
+    from calibre_plugins.comicvine.pycomicvine.sync import CacheSync
+    self.cache_sync = CacheSync(
+      pycomicvine.response_cache(), pycomicvine.resource_cache(),
+      max_pages=PREFS['cache_sync_pages'])
+
+  def run_background_jobs(self):
+    '''Refresh the volume index daily and sync the cache hourly
+
+    Runs for the life of the process, starting after the request that
+    set the plugin up.  Requests made here only use spare tokens (see
+    wait_for_spare_tokens).
+    '''
+    self._background.active = True
+    time.sleep(BACKGROUND_DELAY)
+    while True:
+      if (self.volume_index is not None and
+          self.volume_index.refresh_due(24 * 60 * 60)):
+        self.refresh_volume_index()
+      if self.cache_sync is not None and self.cache_sync.due(60 * 60):
+        self.sync_cache()
+      time.sleep(BACKGROUND_INTERVAL)
+
+  def index_tokens(self, name):
+    'Title tokens of a volume name, as used by utils.normalised_title'
+    return [token.lower() for token in self.get_title_tokens(name)]
+
+  def refresh_volume_index(self):
+    'Load volumes updated since the last refresh into the volume index'
+    try:
+      self.volume_index.refresh(max_pages=PREFS['volume_index_pages'])
+    except:
+      logging.exception('Unable to refresh the volume index')
+
+  def sync_cache(self):
+    'Invalidate cached issues and volumes changed since the last sync'
+    try:
+      self.cache_sync.sync()
+    except:
+      logging.exception('Unable to sync the response cache')
 
   def config_widget(self):
-    from calibre_plugins.comicvine.config import ConfigWidget
+    from calibre_plugins.comicvine.config_widget import ConfigWidget
     return ConfigWidget()
 
   def save_settings(self, config_widget):
@@ -55,6 +184,7 @@ class Comicvine(Source):
   
   def _print_result(self, result, ranking, opf=False):
     if opf:
+      from calibre.ebooks.metadata.opf2 import metadata_to_opf
       result_text = metadata_to_opf(result)
     else:
       if result.pubdate:
@@ -69,6 +199,9 @@ class Comicvine(Source):
 
   def cli_main(self, args):
     'Perform comicvine lookups from the calibre-debug cli'
+    from calibre import setup_cli_handlers
+    from calibre.utils.config import OptionParser
+
     def option_parser():
       'Parse command line options'
       parser = OptionParser(
@@ -105,7 +238,7 @@ class Comicvine(Source):
     self.identify(
       log, result_queue, False, title=title, authors=authors, identifiers=ids)
     ranking = self.identify_results_keygen(title, authors, ids)
-    for result in sorted(result_queue.queue, key=ranking):
+    for result in ranking.sort(result_queue.queue):
       self._print_result(result, ranking, opf=opts.opf)
       if opts.opf:
         break
@@ -122,18 +255,47 @@ class Comicvine(Source):
         result_queue.put(metadata)
       log.debug('Added Issue(%s) to queue' % metadata.title)
 
+  def enqueue_batch(self, log, result_queue, shutdown, issue_ids,
+                    author_ids=None):
+    'Add result entries for a batch of issue ids to the result queue'
+    if shutdown.is_set():
+      raise threading.ThreadError
+    log.debug('Adding %d Issues to queue' % len(issue_ids))
+    for metadata in utils.build_meta_batch(log, issue_ids, author_ids):
+      self.clean_downloaded_metadata(metadata)
+      with self._qlock:
+        result_queue.put(metadata)
+      log.debug('Added Issue(%s) to queue' % metadata.title)
+
+  @staticmethod
+  def _check_deadline(abort, deadline):
+    'Raise TimeoutError if identify was aborted or ran out of time'
+    if (abort and abort.is_set()) or time.time() > deadline:
+      raise TimeoutError()
+
+  def _result(self, future, abort, deadline):
+    'Wait for the result of future, giving up on abort or at deadline'
+    while True:
+      self._check_deadline(abort, deadline)
+      try:
+        return future.result(min(0.5, max(0, deadline - time.time())))
+      except TimeoutError:
+        pass
+
   def identify_results_keygen(self, title=None, authors=None, 
                               identifiers=None):
     'Provide a keying function for result comparison'
     (issue_number, title_tokens) = utils.normalised_title(self, title)
-    return partial(
-      utils.keygen, title=title, authors=authors, identifiers=identifiers,
-      issue_number=issue_number, title_tokens=title_tokens)
+    return RankingEngine(
+      title=title, authors=authors, identifiers=identifiers,
+      issue_number=issue_number, title_tokens=title_tokens,
+      legacy=PREFS['legacy_ranking'])
 
   def identify(self, log, result_queue, abort, 
                title=None, authors=None, identifiers=None, timeout=30):
     '''Attempt to identify comicvine Issue matching given parameters'''
-    
+    self.start()
+
     # Do a simple lookup if comicvine identifier present
     if identifiers:
       comicvine_id = identifiers.get('comicvine')
@@ -143,46 +305,160 @@ class Comicvine(Source):
         return None
 
     if title:
-      # Look up candidate volumes based on title
-      (issue_number, candidate_volumes) = utils.find_title(
-        self, title, log, volumeid=identifiers.get('comicvine-volume'))
-
-      # Look up candidate authors
-      candidate_authors = utils.find_authors(self, authors, log)
-
-      # Look up candidate issues
-      candidate_issues = utils.find_issues(
-        candidate_volumes, issue_number, log)
-
-      # Refine issue selection based on authors
-      if candidate_authors:
-        issues = set()
-        for author in candidate_authors:
-          issues.update(set(author.issues))
-        candidate_issues = issues.intersection(candidate_issues)
-
-      # Queue candidates
-      pool = ThreadPool(PREFS.get('worker_threads'))
+      deadline = time.time() + timeout
+      (issue_number, title_tokens) = utils.normalised_title(self, title)
+      volumeid = (identifiers or {}).get('comicvine-volume')
+      if volumeid:
+        volumeid = int(volumeid)
       shutdown = threading.Event()
-      enqueue = partial(self.enqueue, log, result_queue, shutdown)
+
+      # The author search does not depend on the volume search, so run
+      # them side by side
+      author_search = self.client.submit(
+        utils.find_author_ids, self, authors, log)
+      futures = [author_search]
+      pending = []
+
+      def queue_candidates(block):
+        'Queue candidates of finished issue searches for metadata lookup'
+        while pending and (block or (
+            pending[0].done() and author_search.done())):
+          candidate_issues = self._result(pending.pop(0), abort, deadline)
+          # Issue selection is refined on the person credits of the
+          # candidates once they are loaded
+          enqueue = partial(
+            self.enqueue_batch, log, result_queue, shutdown,
+            author_ids=self._result(author_search, abort, deadline))
+          futures.extend(self.client.map(
+            enqueue, utils.batches(candidate_issues)))
+
       try:
-        pool.map(enqueue, [issue.id for issue in candidate_issues])
+        # Look up candidate issues as each page of volumes arrives
+        for candidate_volumes in utils.find_volume_pages(
+            ' AND '.join(title_tokens), log, volumeid,
+            title_tokens=title_tokens, top_k=PREFS['volume_top_k'],
+            volume_index=self.volume_index):
+          issues = self.client.submit(
+            utils.find_issues, candidate_volumes, issue_number, log)
+          futures.append(issues)
+          pending.append(issues)
+          queue_candidates(False)
+          self._check_deadline(abort, deadline)
+        queue_candidates(True)
+        for future in futures:
+          self._result(future, abort, deadline)
+      except TimeoutError:
+        log.warn('Identify aborted or timed out, results are incomplete')
       finally:
         shutdown.set()
+        for future in futures:
+          future.cancel()
+      log.debug('Resource cache: %(entries)d entries, %(hits)d hits, '
+                '%(misses)d misses, %(evictions)d evictions' % 
+                pycomicvine.resource_cache().stats())
+      log.debug('API requests: %(requests)d, %(coalesced)d coalesced' %
+                pycomicvine.request_stats())
 
     return None
 
+  def read_cover(self, browser, url, abort, deadline):
+    '''Download a cover image in chunks, giving up on abort or at deadline
+
+    Returns the image and the response headers.
+    '''
+    response = browser.open_novisit(
+      url, timeout=max(1, deadline - time.time()))
+    try:
+      chunks = []
+      while True:
+        self._check_deadline(abort, deadline)
+        chunk = response.read(COVER_CHUNK_SIZE)
+        if not chunk:
+          break
+        chunks.append(chunk)
+      headers = response.info()
+    finally:
+      response.close()
+    return (''.join(chunks), headers)
+
+  def fetch_cover(self, browser, issue_id, size, url, abort, deadline):
+    '''Return a cover from the cover cache or download it
+
+    Stale cached covers are revalidated with a conditional request.
+    '''
+    cache = self.cover_cache
+    if cache is None:
+      return self.read_cover(browser, url, abort, deadline)[0]
+    (cached, fresh, conditions) = cache.get(issue_id, size, url)
+    if fresh:
+      return cached
+    browser.addheaders = list(browser.addheaders) + conditions
+    try:
+      (cdata, headers) = self.read_cover(browser, url, abort, deadline)
+    except Exception, error:
+      if cached is not None and getattr(error, 'code', None) == 304:
+        cache.revalidated(issue_id, size)
+        return cached
+      raise
+    cache.put(issue_id, size, url, cdata, headers.get('ETag'),
+              headers.get('Last-Modified'))
+    return cdata
+
   def download_cover(self, log, result_queue, abort, 
                      title=None, authors=None, identifiers=None, 
                      timeout=30, get_best_cover=False):
-    if identifiers and 'comicvine' in identifiers:
-      for url in utils.cover_urls(identifiers['comicvine'], get_best_cover):
-        url = 'http://static.comicvine.com' + url
-        browser = self.browser
-        log('Downloading cover from:', url)
+    '''Download the covers of an issue
+
+    With get_best_cover the sizes are tried in quality order and only
+    the first one downloaded is queued.  Otherwise every size is
+    downloaded concurrently and queued as it arrives.
+    '''
+    if not identifiers or 'comicvine' not in identifiers:
+      return
+    self.start()
+    deadline = time.time() + timeout
+    issue_id = int(identifiers['comicvine'])
+    covers = utils.cover_urls(issue_id)
+
+    def download(size, url, browser):
+      'Download one cover size, returning None on failure'
+      log('Downloading cover from:', url)
+      try:
+        return self.fetch_cover(browser, issue_id, size, url, abort, deadline)
+      except TimeoutError:
+        return None
+      except:
+        log.exception('Failed to download cover from:', url)
+        return None
+
+    downloads = Queue()
+    try:
+      if get_best_cover:
+        # Smaller sizes are only downloaded if the better ones failed
+        for size, url in covers:
+          cdata = download(size, url, self.browser.clone_browser())
+          if cdata:
+            result_queue.put((self, cdata))
+            return
+          self._check_deadline(abort, deadline)
+        return
+      for size, url in covers:
+        thread = threading.Thread(
+          target=lambda *args: downloads.put(download(*args)),
+          args=(size, url, self.browser.clone_browser()),
+          name='cover download')
+        thread.daemon = True
+        thread.start()
+      received = 0
+      while received < len(covers):
+        self._check_deadline(abort, deadline)
         try:
-          cdata = browser.open_novisit(url, timeout=timeout).read()
+          cdata = downloads.get(
+            timeout=min(0.5, max(0, deadline - time.time())))
+        except Empty:
+          continue
+        received += 1
+        if cdata:
           result_queue.put((self, cdata))
-        except:
-          log.exception('Failed to download cover from:', url)
-
+    except TimeoutError:
+      log.warn('Cover download aborted or timed out')
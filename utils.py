@@ -1,24 +1,23 @@
 '''
 calibre_plugins.comicvine - A calibre metadata source for comicvine
 '''
+import heapq
 import logging
 import random
 import re
 import time
-import threading
 
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.utils import logging as calibre_logging # pylint: disable=W0404
-from calibre.utils.config import JSONConfig
 from calibre_plugins.comicvine import pycomicvine
-from calibre_plugins.comicvine.config import PREFS
+from calibre_plugins.comicvine.pycomicvine.cache import ResourceCache
 from pycomicvine.error import RateLimitExceededError
 
-# Optional Import for fuzzy title matching
+# Optional Import for fuzzy title matching, falls back to indel_ratio
 try:
   import Levenshtein
 except ImportError:
-  pass
+  Levenshtein = None
 
 class CalibreHandler(logging.Handler):
   '''
@@ -29,46 +28,7 @@ class CalibreHandler(logging.Handler):
     level = getattr(calibre_logging, record.levelname)
     calibre_logging.default_log.prints(level, record.getMessage())
 
-class TokenBucket(object):
-  def __init__(self):
-    self.lock = threading.RLock()
-    params = JSONConfig('plugins/comicvine_tokens')
-    params.defaults['tokens'] = 0
-    params.defaults['update'] = time.time()
-    self.params = params
-
-  def consume(self):
-    with self.lock:
-      self.params.refresh()
-      rate = PREFS['requests_rate']
-      while self.tokens < 1:
-        if self.params['update'] + 1/rate > time.time():
-          next_token = self.params['update'] + 1/rate - time.time()
-        else:
-          next_token = 1/rate
-        logging.warn(
-            'Slow down cowboy: %0.2f seconds to next token', next_token)
-        time.sleep(next_token)
-      self.params['tokens'] -= 1
-
-  @property
-  def tokens(self):
-    with self.lock:
-      self.params.refresh()
-      if self.params['tokens'] < PREFS['requests_burst']:
-        now = time.time()
-        elapsed = now - self.params['update']
-        if elapsed > 0:
-          new_tokens = int(elapsed * PREFS['requests_rate'])
-          if new_tokens:
-            if new_tokens + self.params['tokens'] < PREFS['requests_burst']:
-              self.params['tokens'] += new_tokens
-            else:
-              self.params['tokens'] = PREFS['requests_burst']
-            self.params['update'] = now
-    return self.params['tokens']
-
-def retry_on_cv_error(retries=2):
+def retry_on_cv_error(retries=2, throttled_retries=4):
   '''Decorator for functions that access the comicvine api. 
 
   Retries the decorated function on error.'''
@@ -78,37 +38,44 @@ def retry_on_cv_error(retries=2):
       '''Decorate function to retry on error.
 
       The comicvine API can be a little flaky, so retry on error to make
-      sure the error is real.
+      sure the error is real.  Rate limit errors are retried separately,
+      the rate limiter pauses requests until the API can be used again.
 
       If retries is exceeded will raise the original exception.
       '''
-      for retry in range(1,retries+1):
+      (retry, throttled) = (1, 0)
+      while True:
         try:
           return target_function(*args, **kwargs)
         except RateLimitExceededError:
-          logging.warn('API Rate limited exceeded.')
-          raise
+          throttled += 1
+          logging.warn('API Rate limited exceeded on attempt %d/%d.',
+                       throttled, throttled_retries)
+          if throttled == throttled_retries:
+            raise
         except:
           logging.warn('Calling %r failed on attempt %d/%d with args: %r %r',
                        target_function, retry, retries, args, kwargs)
           if retry == retries:
             raise
+          retry += 1
           # Failures may be due to busy servers.  Be a good citizen and
           # back off for 100-600 ms before retrying.
           time.sleep(random.random()/2 + 0.1)
-        else:
-          break
     return retry_function
   return wrap_function
 
-@retry_on_cv_error()
-def build_meta(log, issue_id):
-  '''Build metadata record based on comicvine issue_id'''
-  issue = pycomicvine.Issue(issue_id, field_list=[
-      'id', 'name', 'volume', 'issue_number', 'person_credits', 'description', 
-      'store_date', 'cover_date'])
-  if not issue or not issue.volume:
-    log.warn('Unable to load Issue(%d)' % issue_id)
+ISSUE_FIELDS = [
+    'id', 'name', 'volume', 'issue_number', 'person_credits', 'description',
+    'store_date', 'cover_date', 'date_last_updated']
+
+# Maximum number of ids accepted by a single issues/ list filter
+BATCH_SIZE = 100
+
+def issue_meta(log, issue):
+  '''Build metadata record from a hydrated comicvine issue'''
+  if not issue.volume:
+    log.warn('Unable to load Issue(%d)' % issue.id)
     return None
   title = '%s #%s' %  (issue.volume.name, issue.issue_number)
   if issue.name:
@@ -127,25 +94,86 @@ def build_meta(log, issue_id):
   return meta
 
 @retry_on_cv_error()
-def find_volumes(volume_title, log, volumeid=None):
-  '''Look up volumes matching title string'''
-  candidate_volumes = []
-  if volumeid:
-    log.debug('Looking up volume: %d' % volumeid)
-    candidate_volumes = [pycomicvine.Volume(volumeid)]
+def build_meta(log, issue):
+  '''Build metadata record based on comicvine issue_id
+
+  issue may also be an already loaded pycomicvine.Issue, in which case
+  only the fields it is still missing are requested.
+  '''
+  if isinstance(issue, pycomicvine.Issue):
+    issue.ensure_fields(ISSUE_FIELDS)
+  else:
+    issue_id = issue
+    issue = pycomicvine.Issue(issue_id, field_list=ISSUE_FIELDS)
+    if not issue:
+      log.warn('Unable to load Issue(%d)' % issue_id)
+      return None
+  return issue_meta(log, issue)
+
+@retry_on_cv_error()
+def build_meta_batch(log, issues, author_ids=None):
+  '''Build metadata records for up to BATCH_SIZE comicvine issues
+
+  issues may be issue ids or already loaded pycomicvine.Issue objects.
+  All issues are loaded with a single request to the issues list
+  resource rather than one detail request per issue, and only fields
+  missing from pre-loaded issues are requested.  If author_ids is
+  given only issues crediting one of those people are kept.
+  '''
+  loaded = [issue for issue in issues
+            if isinstance(issue, pycomicvine.Issue)]
+  issue_ids = [issue for issue in issues
+               if not isinstance(issue, pycomicvine.Issue)]
+  if issue_ids:
+    field_list = ISSUE_FIELDS
   else:
-    log.debug('Looking up volume: %s' % volume_title)
-    matches = pycomicvine.Volumes.search(
-        query=volume_title, field_list=['id', 'name', 'count_of_issues', 
-                                        'publisher'])
-    for i in range(len(matches)):
-      try:
-        if matches[i]:
-          candidate_volumes.append(matches[i])
-      except IndexError:
-        continue 
-  log.debug('found %d volume matches' % len(candidate_volumes))
-  return candidate_volumes
+    field_list = ['id']
+  for issue in loaded:
+    missing = issue.missing_fields(ISSUE_FIELDS)
+    if missing:
+      field_list = field_list + [
+          field for field in missing if field not in field_list]
+      issue_ids.append(issue.id)
+  if issue_ids:
+    log.debug('Loading %s for Issues(%s)' % (
+        ','.join(field_list), ', '.join(str(i) for i in issue_ids)))
+    fetched = list(pycomicvine.Issues(
+      filter='id:%s' % '|'.join(str(i) for i in issue_ids),
+      field_list=field_list, limit=BATCH_SIZE))
+  else:
+    fetched = []
+  # Fetched fields are merged into loaded issues that are still in the
+  # resource cache.  Evicted ones come back as new objects, which are
+  # given the fields loaded earlier instead.
+  fetched_by_id = dict((issue.id, issue) for issue in fetched)
+  issues = []
+  for issue in loaded:
+    current = fetched_by_id.pop(issue.id, issue)
+    if current is not issue:
+      current.copy_fields(issue)
+    issues.append(current)
+  issues.extend(issue for issue in fetched if issue.id in fetched_by_id)
+  if author_ids is not None:
+    issues = [issue for issue in issues if credited(issue, author_ids)]
+  return [meta for meta in (issue_meta(log, issue) for issue in issues)
+          if meta]
+
+def batches(issue_ids, size=BATCH_SIZE):
+  '''Split issue_ids into lists of at most size ids'''
+  issue_ids = list(issue_ids)
+  return [issue_ids[i:i + size] for i in range(0, len(issue_ids), size)]
+
+@retry_on_cv_error()
+def search_volumes(volume_title):
+  '''Start a volume search for title string'''
+  return pycomicvine.Volumes.search(
+      query=volume_title, field_list=['id', 'name', 'count_of_issues', 
+                                      'publisher', 'start_year'])
+
+@retry_on_cv_error()
+def find_volume(volumeid):
+  '''Load a volume by id'''
+  return pycomicvine.Volume(volumeid)
 
 @retry_on_cv_error()
 def find_issues(candidate_volumes, issue_number, log):
@@ -165,6 +193,108 @@ def find_issues(candidate_volumes, issue_number, log):
   log.debug('%d matches found' % len(candidate_issues))
   return candidate_issues
 
+# Do not include the retry decorator for generator, as exceptions in
+# generators are always fatal.  Each request it makes is retried instead.
+def find_volume_pages(volume_title, log, volumeid=None, max_results=None,
+                      title_tokens=None, top_k=0, volume_index=None):
+  '''Yield lists of volumes matching title string as they are loaded
+
+  With top_k set, volumes are scored against title_tokens as pages
+  arrive and only volumes entering the top_k best scores are yielded.
+  The search stops once the top_k scores are all perfect, or a whole
+  page fails to improve them (results arrive in relevance order).
+
+  If volume_index is given it is consulted for title_tokens first, and
+  volumes found by the API are written through to it.  The ids of a
+  search read to the end are recorded for the next lookup.
+  '''
+  if volumeid:
+    log.debug('Looking up volume: %d' % volumeid)
+    yield [find_volume(volumeid)]
+    return
+  if volume_index is not None and title_tokens:
+    volumes = volume_index.lookup(title_tokens)
+    if volumes is not None:
+      log.debug('Found %d volumes in the volume index' % len(volumes))
+      if top_k:
+        volumes = heapq.nsmallest(
+          top_k, volumes,
+          key=lambda volume: score_volume(volume.name, title_tokens))
+      yield volumes
+      return
+  log.debug('Looking up volume: %s' % volume_title)
+  matches = search_volumes(volume_title)
+  best = [] # max-heap of the top_k (negated) scores
+  found = []
+  complete = max_results is None
+  # In top_k mode the next page may not be needed, so it is not
+  # prefetched
+  for page in matches.pages(prefetch=not top_k, max_results=max_results,
+                            retry=retry_on_cv_error()):
+    volumes = [volume for volume in page if volume]
+    if volume_index is not None:
+      volume_index.add(volumes)
+      found.extend(volume.id for volume in volumes)
+    if top_k:
+      ranked = []
+      for volume in volumes:
+        score = score_volume(volume.name, title_tokens)
+        if len(best) < top_k:
+          heapq.heappush(best, -score)
+        elif score < -best[0]:
+          heapq.heapreplace(best, -score)
+        else:
+          continue
+        ranked.append(volume)
+      if not ranked and len(best) == top_k:
+        log.debug('Stopping volume search, page did not improve top %d' %
+                  top_k)
+        complete = False
+        break
+      volumes = ranked
+    if volumes:
+      yield volumes
+    if top_k and len(best) == top_k and best[0] == 0:
+      log.debug('Stopping volume search, found %d exact matches' % top_k)
+      complete = False
+      break
+  if volume_index is not None and complete and title_tokens:
+    # Every match is now indexed, later lookups can skip the search
+    volume_index.add_search(title_tokens, found)
+
+def score_volume(name, title_tokens):
+  '''
+  Score a volume name against normalised title tokens, 0 is a perfect match
+  '''
+  name_tokens = re.findall(r'\w+', (name or '').lower(), re.UNICODE)
+  score = 10 * len([token for token in title_tokens
+                    if token not in name_tokens])
+  return score + abs(len(name_tokens) - len(title_tokens))
+
+# Title normalisation patterns, applied in order
+TITLE_REPLACEMENTS = tuple((re.compile(pattern), replacement)
+                           for pattern, replacement in (
+  (r'((?:^|\s)(?:\w\.){2,})', lambda match: match.group(0).replace('.', '')),
+  (r'\s\(?of \d+\)?', ''),
+  (r'(?:v|vol)\s?\d+', ''),
+  (r'\([^)]+\)', ''),
+  (u'(?:# ?)?0*([\d\xbd]+[^:\s]*):?[^\d]*$', '#\g<1>'),
+  (r'\s{2,}', ' '),
+))
+ISSUE_PATTERN = re.compile('#([^:\s]+)')
+YEAR_PATTERN = re.compile(r'\((\d{4})\)')
+COLLECTION_PATTERN = re.compile(r'(?:collect|contain)(?:s|ing) issues')
+
+# Memos of title and metadata derived scoring inputs
+NORMALISED_TITLES = ResourceCache(max_entries=1024, default_ttl=None)
+TITLE_INPUTS = ResourceCache(max_entries=1024, default_ttl=None)
+METADATA_INPUTS = ResourceCache(max_entries=4096, default_ttl=None)
+
+def clear_title_caches():
+  '''Forget memoised title normalisation and scoring inputs'''
+  for cache in (NORMALISED_TITLES, TITLE_INPUTS, METADATA_INPUTS):
+    cache.clear()
+
 def normalised_title(query, title):
   '''
   returns (issue_number,title_tokens)
@@ -175,35 +305,20 @@ def normalised_title(query, title):
   provided after the issue number (e.g. a sub-title) will be
   ignored.
   '''
-  title_tokens = []
-  issue_number = None
-  replacements = (
-    (r'((?:^|\s)(?:\w\.){2,})', lambda match: match.group(0).replace('.', '')),
-    (r'\s\(?of \d+\)?', ''),
-    (r'(?:v|vol)\s?\d+', ''),
-    (r'\([^)]+\)', ''),
-    (u'(?:# ?)?0*([\d\xbd]+[^:\s]*):?[^\d]*$', '#\g<1>'),
-    (r'\s{2,}', ' '),
-  )
-  for pattern, replacement in replacements:
-    title = re.sub(pattern, replacement, title)
-  issue_pattern = re.compile('#([^:\s]+)')
-  issue_match = issue_pattern.search(title)
-  if issue_match:
-    issue_number = issue_match.group(1)
-    title = issue_pattern.sub('', title)
-  for token in query.get_title_tokens(title):
-    title_tokens.append(token.lower())
-  return issue_number, title_tokens
-
-def find_title(query, title, log, volumeid=None):
-  '''Extract volume name and issue number from issue title'''
-  (issue_number, title_tokens) = normalised_title(query, title)
-  log.debug("Searching for %s #%s" % (title_tokens, issue_number))
-  if volumeid:
-    volumeid = int(volumeid)
-  candidate_volumes = find_volumes(' AND '.join(title_tokens), log, volumeid)
-  return (issue_number, candidate_volumes)
+  normalised = NORMALISED_TITLES.get(title)
+  if normalised is None:
+    issue_number = None
+    raw_title = title
+    for pattern, replacement in TITLE_REPLACEMENTS:
+      title = pattern.sub(replacement, title)
+    issue_match = ISSUE_PATTERN.search(title)
+    if issue_match:
+      issue_number = issue_match.group(1)
+      title = ISSUE_PATTERN.sub('', title)
+    normalised = (issue_number, tuple(
+        token.lower() for token in query.get_title_tokens(title)))
+    NORMALISED_TITLES.put(raw_title, normalised)
+  return normalised[0], list(normalised[1])
 
 @retry_on_cv_error()
 def find_authors(query, authors, log):
@@ -218,75 +333,145 @@ def find_authors(query, authors, log):
     log.debug("%d matches found" % len(candidate_authors))
   return candidate_authors
 
-def score_title(metadata, title=None, issue_number=None, title_tokens=None):
+def find_author_ids(query, authors, log):
+  '''Find ids of people matching author string
+
+  Returns None if no matching people were found.
   '''
-  Calculate title matching ranking
+  candidate_authors = find_authors(query, authors, log)
+  if not candidate_authors:
+    return None
+  return set(author.id for author in candidate_authors)
+
+def credited(issue, author_ids):
+  '''Check whether any of author_ids is credited on a hydrated issue'''
+  return any(person.id in author_ids for person in issue.person_credits)
+
+def _char_masks(pattern):
+  'Bit mask of the positions of each character in pattern'
+  masks = {}
+  for i, char in enumerate(pattern):
+    masks[char] = masks.get(char, 0) | (1 << i)
+  return masks
+
+def edit_distance(source, target, max_distance=None):
   '''
-  score = 0
-  volume = '%s #%s' % (metadata.series.lower(), metadata.series_index)
-  match_year = re.compile(r'\((\d{4})\)')
-  year = match_year.search(title)
-  if year:
-    title = match_year.sub('', title)
-    if metadata.pubdate:
-      score += abs(metadata.pubdate.year - int(year.group(1)))
-    else:
-      score += 10 # penalise entries with no publication date
-  score += abs(len(volume) - len(title))
-  for token in title_tokens:
-    if token not in volume:
-      score += 10
-    try:
-      similarity = Levenshtein.ratio(unicode(volume), unicode(title))
-      score += 100 - int(100 * similarity)
-    except NameError:
-      pass
-  if issue_number is not None and metadata.series_index != issue_number:
-    score += 50
-  if metadata.series_index not in title:
-    score += 10
-  # De-preference TPBs by looking for the phrases "collecting issues", 
-  # "containing issues", etc. in the comments
-  # TODO(rgh): This should really be controlled by config
-  collection = re.compile(r'(?:collect|contain)(?:s|ing) issues')
-  if metadata.comments and collection.search(metadata.comments.lower()):
-    score += 50
-
-  return score
-
-def keygen(metadata, title=None, authors=None, identifiers=None, **kwargs):
+  Levenshtein distance between two strings.
+
+  Uses Myers' bit-parallel algorithm, processing a column of the
+  distance matrix per character of target.  If max_distance is given
+  the computation stops as soon as the distance is known to exceed it,
+  returning max_distance + 1.
+
+  Ranking uses indel_ratio instead: it is cheaper per column, and the
+  bound only ends the loop early enough to pay for itself when it is
+  tight enough to change the similarity penalty of poor candidates.
   '''
-  Implement multi-result comparisons.
-  
-  1. Prefer an entry where the comicvine id matches
-  2. Prefer similar titles using Levenshtein ratio (if module available)
-  3. Penalise entries where the issue number is not in the title
-  4. Prefer matching authors (the more matches, the higher the preference)
+  if len(source) < len(target):
+    (source, target) = (target, source)
+  length = len(source)
+  if max_distance is not None and length - len(target) > max_distance:
+    return max_distance + 1
+  if not target:
+    return length
+  masks = _char_masks(source)
+  mask = (1 << length) - 1
+  last = 1 << (length - 1)
+  (positive, negative, distance) = (mask, 0, length)
+  remaining = len(target)
+  for char in target:
+    remaining -= 1
+    equal = masks.get(char, 0)
+    vertical = equal | negative
+    horizontal = ((((equal & positive) + positive) & mask) ^ positive) | equal
+    hpositive = (negative | ~(horizontal | positive)) & mask
+    hnegative = positive & horizontal
+    if hpositive & last:
+      distance += 1
+    elif hnegative & last:
+      distance -= 1
+    hpositive = (hpositive << 1) | 1
+    hnegative = hnegative << 1
+    positive = (hnegative | ~(vertical | hpositive)) & mask
+    negative = hpositive & vertical & mask
+    # Each remaining column can lower the distance by at most one
+    if max_distance is not None and distance - remaining > max_distance:
+      return max_distance + 1
+  return distance
+
+def indel_ratio(source, target):
   '''
-  score = 0
-  if identifiers:
-    try:
-      if metadata.get_identifier('comicvine') == identifiers['comicvine']:
-        return 0
-    except (KeyError, AttributeError):
-      pass
-  if title:
-    score += score_title(metadata, title=title, **kwargs)
-  if authors:
-    for author in authors:
-      if author not in metadata.authors:
-        score += 10
-  return score
+  Similarity ratio of two strings, as calculated by Levenshtein.ratio.
 
-# Do not include the retry decorator for generator, as exceptions in
-# generators are always fatal.  Functions that use this should be
-# decorated instead.
+  The ratio is 2 * LCS / (len(source) + len(target)), with the longest
+  common subsequence found using a bit-parallel algorithm.
+  '''
+  total = len(source) + len(target)
+  if not total:
+    return 1.0
+  if not source or not target:
+    return 0.0
+  masks = _char_masks(source)
+  mask = (1 << len(source)) - 1
+  row = mask
+  for char in target:
+    matches = row & masks.get(char, 0)
+    row = ((row + matches) | (row - matches)) & mask
+  common = len(source) - bin(row).count('1')
+  return 2.0 * common / total
+
+def similarity(volume, title):
+  '''Levenshtein ratio of two strings'''
+  if Levenshtein is None:
+    return indel_ratio(unicode(volume), unicode(title))
+  return Levenshtein.ratio(unicode(volume), unicode(title))
+
+def title_inputs(title):
+  '''returns (title, year) with any (year) removed from the title'''
+  inputs = TITLE_INPUTS.get(title)
+  if inputs is None:
+    year = YEAR_PATTERN.search(title)
+    if year:
+      inputs = (YEAR_PATTERN.sub('', title), int(year.group(1)))
+    else:
+      inputs = (title, None)
+    TITLE_INPUTS.put(title, inputs)
+  return inputs
+
+def metadata_inputs(metadata):
+  '''returns (volume, is_collection) for a result'''
+  key = (metadata.series, metadata.series_index, metadata.comments)
+  inputs = METADATA_INPUTS.get(key)
+  if inputs is None:
+    volume = '%s #%s' % (metadata.series.lower(), metadata.series_index)
+    # De-preference TPBs by looking for the phrases "collecting issues", 
+    # "containing issues", etc. in the comments
+    # TODO(rgh): This should really be controlled by config
+    is_collection = bool(metadata.comments and
+                         COLLECTION_PATTERN.search(metadata.comments.lower()))
+    inputs = (volume, is_collection)
+    METADATA_INPUTS.put(key, inputs)
+  return inputs
+
+# Image sizes offered as covers, in quality order
+COVER_SIZES = ['super_url', 'medium_url', 'small_url']
+
+@retry_on_cv_error()
 def cover_urls(comicvine_id, get_best_cover=False):
-  'Retrieve cover urls for comic in quality order'
-  issue = pycomicvine.Issue(int(comicvine_id), field_list=['image'])
-  for url in ['super_url', 'medium_url', 'small_url']:
-    if url in issue.image:
-      yield issue.image[url]
+  '''Retrieve (size, url) of the covers for comic in quality order
+
+  The image field loaded with the issue search is reused when the issue
+  is still cached, otherwise only that field is requested.
+  '''
+  issue = pycomicvine.Issue(int(comicvine_id), do_not_download=True)
+  issue.ensure_fields(['image'])
+  urls = []
+  for size in COVER_SIZES:
+    url = (issue.image or {}).get(size)
+    if url:
+      if url.startswith('/'):
+        url = 'http://static.comicvine.com' + url
+      urls.append((size, url))
       if get_best_cover:
         break
-  
+  return urls
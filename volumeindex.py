@@ -0,0 +1,219 @@
+'''
+calibre_plugins.comicvine - local volume index
+'''
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from calibre_plugins.comicvine import pycomicvine
+from calibre_plugins.comicvine.pycomicvine.sync import (DATE_FORMAT,
+                                                        window_end)
+
+# Fields stored for every indexed volume
+VOLUME_FIELDS = ['id', 'name', 'start_year', 'publisher', 'count_of_issues']
+
+class VolumeIndex(object):
+  '''On-disk inverted index of volume names stored in SQLite.
+
+  Volume names are split into title tokens with tokenise (the same
+  tokeniser normalised_title uses for the title being identified), and
+  each token maps to the ids of the volumes containing it.
+
+  The index is filled in two ways: volumes found by searches are
+  written through with add(), and refresh() walks the volumes list
+  sorted by date_last_updated, continuing from where the last refresh
+  stopped.  The ids a completed search returned are recorded with
+  add_search(), and a lookup of the same title within search_ttl
+  seconds returns them, since the API search is fuzzy and finds names
+  not containing every title token.  Other titles are only answered
+  from the tokens once a refresh has loaded every volume.  Lookups
+  finding nothing are misses, so the API is searched instead.
+  '''
+  def __init__(self, path, tokenise, search_ttl=7 * 24 * 60 * 60,
+               clock=time.time):
+    self.path = path
+    self.tokenise = tokenise
+    self.search_ttl = search_ttl
+    self.clock = clock
+    self.lock = threading.RLock()
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    with self.lock:
+      self.db.executescript('''
+        CREATE TABLE IF NOT EXISTS volumes (
+          id INTEGER PRIMARY KEY, name TEXT, start_year INTEGER,
+          publisher_id INTEGER, publisher TEXT, count_of_issues INTEGER);
+        CREATE TABLE IF NOT EXISTS tokens (
+          token TEXT, volume INTEGER, PRIMARY KEY (token, volume));
+        CREATE INDEX IF NOT EXISTS tokens_volume ON tokens (volume);
+        CREATE TABLE IF NOT EXISTS searches (
+          query TEXT PRIMARY KEY, stored REAL);
+        CREATE TABLE IF NOT EXISTS search_results (
+          query TEXT, rank INTEGER, volume INTEGER,
+          PRIMARY KEY (query, rank));
+        CREATE TABLE IF NOT EXISTS state (
+          name TEXT PRIMARY KEY, value TEXT);
+      ''')
+      self.db.commit()
+
+  def _state(self, name):
+    row = self.db.execute(
+      'SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+    return row and row[0]
+
+  def _set_state(self, name, value):
+    self.db.execute(
+      'INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)',
+      (name, value))
+
+  @staticmethod
+  def _query(title_tokens):
+    return u' '.join(sorted(set(title_tokens)))
+
+  @property
+  def complete(self):
+    'True once a refresh has loaded every volume'
+    with self.lock:
+      return self._state('complete') == '1'
+
+  def refresh_due(self, interval):
+    'True if no refresh was started in the last interval seconds'
+    with self.lock:
+      refreshed = self._state('refreshed')
+    return refreshed is None or self.clock() - float(refreshed) >= interval
+
+  def add(self, volumes):
+    '''Store volumes
+
+    Volumes must have the fields in VOLUME_FIELDS loaded.
+    '''
+    with self.lock:
+      for volume in volumes:
+        if not volume:
+          continue
+        publisher = volume.publisher
+        self.db.execute(
+          'INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?, ?, ?)',
+          (volume.id, volume.name, volume.start_year,
+           publisher and publisher.id, publisher and publisher.name,
+           volume.count_of_issues))
+        self.db.execute('DELETE FROM tokens WHERE volume = ?', (volume.id,))
+        self.db.executemany(
+          'INSERT OR IGNORE INTO tokens (token, volume) VALUES (?, ?)',
+          [(token, volume.id)
+           for token in set(self.tokenise(volume.name or ''))])
+      self.db.commit()
+
+  def add_search(self, title_tokens, volume_ids):
+    'Record the ids of every volume a search for title_tokens returned'
+    query = self._query(title_tokens)
+    with self.lock:
+      self.db.execute(
+        'INSERT OR REPLACE INTO searches (query, stored) VALUES (?, ?)',
+        (query, self.clock()))
+      self.db.execute('DELETE FROM search_results WHERE query = ?', (query,))
+      self.db.executemany(
+        'INSERT INTO search_results (query, rank, volume) VALUES (?, ?, ?)',
+        [(query, rank, volume_id)
+         for rank, volume_id in enumerate(volume_ids)])
+      self.db.commit()
+
+  def lookup(self, title_tokens):
+    '''Volumes for title tokens, None if the index cannot answer
+
+    Results are pycomicvine.Volume objects built without a request, in
+    the order the recorded search returned them, or shortest names first
+    when matched on the tokens.
+    '''
+    tokens = sorted(set(title_tokens))
+    if not tokens:
+      return None
+    columns = ('v.id, v.name, v.start_year, v.publisher_id, v.publisher, '
+               'v.count_of_issues')
+    with self.lock:
+      row = self.db.execute(
+        'SELECT stored FROM searches WHERE query = ?',
+        (self._query(tokens),)).fetchone()
+      if row is not None and self.clock() - row[0] <= self.search_ttl:
+        rows = self.db.execute(
+          'SELECT %s FROM volumes v JOIN search_results r ON r.volume = v.id '
+          'WHERE r.query = ? ORDER BY r.rank' % columns,
+          (self._query(tokens),)).fetchall()
+      elif self.complete:
+        rows = self.db.execute(
+          'SELECT %s FROM volumes v JOIN tokens t ON t.volume = v.id '
+          'WHERE t.token IN (%s) GROUP BY v.id HAVING COUNT(*) = ? '
+          'ORDER BY LENGTH(v.name), v.id' % (
+            columns, ', '.join('?' * len(tokens))),
+          tokens + [len(tokens)]).fetchall()
+      else:
+        return None
+    if not rows:
+      return None
+    volumes = []
+    for (volume_id, name, start_year, publisher_id, publisher,
+         count_of_issues) in rows:
+      fields = dict(name=name, start_year=start_year,
+                    count_of_issues=count_of_issues, publisher=None)
+      if publisher_id is not None:
+        fields['publisher'] = {'id': publisher_id, 'name': publisher}
+      volumes.append(
+        pycomicvine.Volume(volume_id, do_not_download=True, **fields))
+    return volumes
+
+  def refresh(self, max_pages=None, until=None):
+    '''Load volumes updated since the last refresh
+
+    Volumes are requested in date_last_updated order and the position is
+    saved after every page, so refreshes limited to max_pages continue
+    where the previous one stopped.  Returns the number of volumes
+    stored.
+    '''
+    until = until or window_end()
+    with self.lock:
+      since = self._state('updated') or '1970-01-01 00:00:00'
+      self._set_state('refreshed', repr(self.clock()))
+      self.db.commit()
+    volumes = pycomicvine.Volumes(
+      filter='date_last_updated:%s|%s' % (since, until.strftime(DATE_FORMAT)),
+      sort='date_last_updated:asc',
+      field_list=VOLUME_FIELDS + ['date_last_updated'],
+      # The window ends at the current time, so the responses could never
+      # be used again
+      cache=False)
+    (stored, pages) = (0, 0)
+    for page in volumes.pages(prefetch=False):
+      page = [volume for volume in page if volume]
+      with self.lock:
+        self.add(page)
+        if page:
+          self._set_state('updated', max(
+            volume.date_last_updated for volume in page).strftime(
+              DATE_FORMAT))
+          self.db.commit()
+      stored += len(page)
+      pages += 1
+      if max_pages is not None and pages >= max_pages:
+        break
+    else:
+      with self.lock:
+        self._set_state('complete', '1')
+        self.db.commit()
+    logging.info('Volume index refresh stored %d volumes', stored)
+    return stored
+
+  def stats(self):
+    'Number of indexed volumes and tokens'
+    with self.lock:
+      (volumes,) = self.db.execute('SELECT COUNT(*) FROM volumes').fetchone()
+      (tokens,) = self.db.execute('SELECT COUNT(*) FROM tokens').fetchone()
+    return {'volumes': volumes, 'tokens': tokens}
+
+  def close(self):
+    'Close the index database'
+    with self.lock:
+      self.db.close()